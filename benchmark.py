@@ -0,0 +1,567 @@
+import igo
+import csv
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from PIL import Image
+
+try:
+    import resource # Nomes existeix a Unix, per la memoria maxima del proces
+except ImportError:
+    resource = None
+
+
+
+# Constants
+N_QUERIES = 50
+SEED = 2021
+GRAPH_EDGES = 500000 # Arestes del graf sintetic de la preparacio del graf
+FEED_ROWS = 200000 # Linies dels fitxers sintetics de congestions i trams
+
+SUITE_REGION = 'benchmark' # Regio on es carrega el graf de la bateria de proves
+SUITE_SIDE = 60 # Nodes de cada costat de la quadricula del graf sintetic
+SUITE_QUERIES = 200 # Parelles origen-desti de les rutes
+SUITE_IMAGES = 30 # Parelles de les que tambe es pinta la imatge
+SUITE_REPEAT = 5 # Repeticions de les mesures curtes (carrega i construccio del igraph)
+SUITE_MODES = ['dijkstra', 'bidijkstra', 'astar', 'cch', 'tdijkstra']
+SUITE_CHANGED = 0.1 # Fraccio dels trams que canvien d'estat entre les dues congestions
+
+
+
+# Escull parelles origen-desti fixes a partir dels nodes del graf
+def _sample_pairs(csr, n, seed):
+
+    rnd = random.Random(seed)
+    pairs = []
+
+    for _ in range(n):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+        pairs.append(((float(csr.x[org]), float(csr.y[org])), (float(csr.x[dest]), float(csr.y[dest]))))
+
+    return pairs
+
+
+# Ruta amb networkx sobre el graf indicat (com es feia abans del CSR)
+def _route_networkx(graph, org, dest):
+
+    org_node = igo.ox.distance.nearest_nodes(graph, org[0], org[1])
+    dest_node = igo.ox.distance.nearest_nodes(graph, dest[0], dest[1])
+
+    try:
+        return igo.ox.distance.shortest_path(graph, org_node, dest_node, weight='itime')
+    except:
+        return None
+
+
+# Ruta amb el CSR del igraph resident (la part de shortest_path que depen del graf)
+def _route_csr(igraph, org, dest):
+
+    org_node, dest_node = igo._nearest_nodes(igraph.system, [org[0], dest[0]], [org[1], dest[1]])
+    return igo._get_shortest_ipath(igraph, org_node, dest_node)
+
+
+# Mesura el temps de cada consulta i en retorna el resum en milisegons
+def _measure(pairs, query):
+
+    times = []
+    for org, dest in pairs:
+        t0 = time.perf_counter()
+        query(org, dest)
+        times.append((time.perf_counter() - t0) * 1000)
+
+    return _summary(times)
+
+
+# Resum d'una llista de temps: mitjana, minim, maxim i percentils
+def _summary(times):
+
+    times = sorted(times)
+    percentile = lambda p: times[min(len(times) - 1, int(len(times) * p))]
+
+    return {
+        'n': len(times),
+        'mean': statistics.mean(times),
+        'min': times[0],
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': times[-1],
+    }
+
+
+# Mostra el resum d'una mesura
+def _report(name, result):
+
+    print('%-20s mitjana %8.2f ms   p50 %8.2f ms   p95 %8.2f ms' % (name, result['mean'], result['p50'], result['p95']))
+
+
+# Abans: es carrega el pickle del graf a cada peticio
+def _before(org, dest):
+
+    _route_networkx(igo._load_graph(igo.GRAPH_FILENAME), org, dest)
+
+
+# Despres: es fa servir el graf resident en memoria
+def _after(org, dest):
+
+    _route_csr(igo._get_igraph(), org, dest)
+
+
+# Mostra la latencia de les rutes amb el graf carregat de disc i amb el graf resident
+def benchmark_graph_service(n=N_QUERIES):
+
+    igo.start_system()
+    pairs = _sample_pairs(igo._get_igraph().csr, n, SEED)
+
+    for name, query in (('pickle per peticio', _before), ('graf resident', _after)):
+        _report(name, _measure(pairs, query))
+
+
+# Compara el temps de carrega del graf en pickle i en format binari
+def benchmark_graph_load(repeat=5):
+
+    for name, load in (('pickle', lambda: igo._load_graph(igo.GRAPH_FILENAME)), ('binari (memmap)', lambda: igo._load_binary_graph(igo.BINARY_GRAPH_DIRNAME))):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            load()
+            times.append((time.perf_counter() - t0) * 1000)
+
+        print('carrega %-16s %8.1f ms' % (name, min(times)))
+
+
+# Compara el motor de networkx amb el del CSR sobre el mateix graf resident
+def benchmark_routing(n=N_QUERIES):
+
+    igo.start_system()
+    igraph = igo._get_igraph()
+    csr = igraph.csr
+    graph = igo._load_graph(igo.GRAPH_FILENAME)
+
+    # Parelles de nodes ja trobats, per mesurar nomes el cami mes curt
+    rnd = random.Random(SEED)
+    pairs = [tuple(rnd.sample(range(len(csr.nodes)), 2)) for _ in range(n)]
+
+    def networkx(org, dest):
+        try:
+            igo.nx.shortest_path(graph, int(csr.nodes[org]), int(csr.nodes[dest]), weight='itime')
+        except igo.nx.NetworkXNoPath:
+            pass
+
+    def compact(org, dest):
+        igo._get_shortest_ipath(igraph, org, dest, 'dijkstra')
+
+    def bidirectional(org, dest):
+        igo._get_shortest_ipath(igraph, org, dest, 'bidijkstra')
+
+    def astar(org, dest):
+        igo._get_shortest_ipath(igraph, org, dest, 'astar')
+
+    def forecast(org, dest):
+        igo._get_shortest_ipath(igraph, org, dest, 'tdijkstra')
+
+    # La jerarquia es preprocessa un cop i es personalitza un cop per versio publicada (la primera consulta)
+    t0 = time.perf_counter()
+    cch = igo._get_cch(igraph.system)
+    t1 = time.perf_counter()
+    igo._customize_cch(cch, igraph.weights)
+    t2 = time.perf_counter()
+    print('CCH: preprocessat %.2f s, personalitzacio %.2f s' % (t1 - t0, t2 - t1))
+
+    def contraction(org, dest):
+        igo._get_shortest_ipath(igraph, org, dest, 'cch')
+
+    for name, query in (('networkx', networkx), ('CSR Dijkstra', compact), ('CSR bidireccional', bidirectional), ('CSR A*', astar), ('CCH', contraction), ('CSR amb previsio', forecast)):
+        _report(name, _measure(pairs, query))
+
+    for name, check in (('A*', igo._check_astar), ('Bidireccional', igo._check_bidijkstra)):
+        errors, settled = check(igraph, n, SEED)
+        print('%s: %d camins amb cost diferent, %.0f de %d nodes visitats de mitjana' % (name, errors, settled, len(csr.nodes)))
+
+    print('Amb previsio: %d camins amb cost diferent' % igo._check_tdijkstra(igraph, n, SEED))
+
+# Compara N rutes separades amb una sola consulta d'un origen a N destins
+def benchmark_batch(n=N_QUERIES):
+
+    igo.start_system()
+    pairs = _sample_pairs(igo._get_igraph().csr, n, SEED)
+    org, dests = pairs[0][0], [dest for _, dest in pairs]
+
+    for name, query in (('%d rutes' % n, lambda: [igo.route(org, dest, 'dijkstra') for dest in dests]),
+                        ('1 origen, %d destins' % n, lambda: igo.routes(org, dests)),
+                        ('matriu %d x %d' % (n, n), lambda: igo.travel_time_matrix([org for org, _ in pairs], dests))):
+        t0 = time.perf_counter()
+        query()
+        print('%-20s %8.1f ms' % (name, (time.perf_counter() - t0) * 1000))
+
+
+# Graf sintetic amb valors de 'maxspeed' com els d'OSM (text, llista o sense)
+def _synthetic_graph(edges, seed):
+
+    rnd = random.Random(seed)
+    speeds = ['30', '50', '20', ['30', '50'], None, None]
+    graph = igo.nx.DiGraph()
+
+    for i in range(edges):
+        data = {'length': rnd.uniform(10, 300)}
+        speed = rnd.choice(speeds)
+        if speed is not None:
+            data['maxspeed'] = list(speed) if type(speed) == list else speed
+        graph.add_edge(i, i + 1, **data)
+
+    return graph
+
+
+# Preparacio de les arestes com es feia abans: un diccionari darrere l'altre
+def _old_prepare_graph(digraph):
+
+    for node1 in digraph.nodes:
+        for node2 in digraph.adj[node1]:
+
+            speed = digraph[node1][node2].get('maxspeed', None)
+            length = digraph[node1][node2].get('length', None)
+
+            if type(speed) == list:
+                speed = sum(list(map(float, speed))) / len(speed)
+
+            if speed == None:
+                digraph[node1][node2]['maxspeed'] = igo.GENERIC_SPEED
+                speed = igo.GENERIC_SPEED
+
+            time = float(length) / float(speed)
+            digraph[node1][node2]['time'] = time
+            digraph[node1][node2]['congestion'] = igo.GENERIC_CONGESTION
+            digraph[node1][node2]['itime'] = igo._calculate_itime(time, igo.GENERIC_CONGESTION)
+
+    return digraph
+
+
+# Compara la preparacio de les arestes del graf abans i despres sobre un graf sintetic gran
+def benchmark_graph_preparation(edges=GRAPH_EDGES):
+
+    for name, prepare in (('preparacio abans', _old_prepare_graph), ('preparacio despres', igo._prepare_graph)):
+        graph = _synthetic_graph(edges, SEED)
+        t0 = time.perf_counter()
+        prepare(graph)
+        print('%-20s %8.1f ms   %d arestes' % (name, (time.perf_counter() - t0) * 1000, edges))
+
+
+# Escriu uns fitxers de trams i congestions sintetics amb el format de l'Ajuntament
+def _write_feeds(dirname, rows, seed):
+
+    rnd = random.Random(seed)
+    highways_filename = os.path.join(dirname, 'highways.csv')
+    congestions_filename = os.path.join(dirname, 'congestions.csv')
+
+    with open(highways_filename, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Tram', 'Descripció', 'Coordenades'])
+        for way_id in range(1, rows + 1):
+            coordinates = [c for _ in range(rnd.randint(2, 8)) for c in (2.1 + rnd.random() / 10, 41.35 + rnd.random() / 10)]
+            writer.writerow([way_id, 'Tram %d' % way_id, ','.join('%.6f' % c for c in coordinates)])
+
+    with open(congestions_filename, 'w', encoding='utf-8') as file:
+        file.write('Tram#Data#EstatActual#EstatPrevist\n')
+        for way_id in range(1, rows + 1):
+            file.write('%d#20210520101505#%d#%d\n' % (way_id, rnd.randint(0, 6), rnd.randint(0, 6)))
+
+    return highways_filename, congestions_filename
+
+
+# Lectura de les congestions com es feia abans: tot el fitxer en memoria i cada fila passada per repr
+def _old_congestions(filename):
+
+    with open(filename, 'rb') as file:
+        lines = [l.decode('utf-8') for l in file.readlines()]
+        reader = csv.reader(lines, delimiter=',', quotechar='"')
+        next(reader)
+
+        congestions = {}
+        for line in reader:
+            way_id, data_hour, state, next_state = str(line)[2:-2].split('#')
+            congestions[int(way_id)] = igo.Congestion(int(state), int(next_state))
+
+        return congestions
+
+
+# Compara la lectura de les dades de l'Ajuntament abans i despres, sobre fitxers sintetics grans
+def benchmark_feeds(rows=FEED_ROWS):
+
+    with tempfile.TemporaryDirectory() as dirname:
+        highways_filename, congestions_filename = _write_feeds(dirname, rows, SEED)
+
+        for name, read in (('congestions abans', lambda: _old_congestions(congestions_filename)),
+                           ('congestions despres', lambda: igo._get_congestions(congestions_filename)[1]),
+                           ('trams', lambda: igo._get_highways(highways_filename))):
+            t0 = time.perf_counter()
+            result = read()
+            print('%-20s %8.1f ms   %d files' % (name, (time.perf_counter() - t0) * 1000, len(result)))
+
+
+# Temps (ms) de cada crida a "function"
+def _timings(repeat, function):
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - t0) * 1000)
+
+    return times
+
+
+# Graf sintetic d'una ciutat: quadricula de "side" x "side" nodes al voltant de Barcelona
+# amb els carrers en els dos sentits (alguns tallats) i velocitats com les d'OSM
+def _synthetic_city(side, seed):
+
+    rnd = random.Random(seed)
+    speeds = ['30', '50', '20', ['30', '50'], None]
+    graph = igo.nx.DiGraph(crs='epsg:4326')
+
+    for i in range(side):
+        for j in range(side):
+            graph.add_node(i * side + j, x=2.12 + j * 0.0015 + rnd.uniform(-0.0003, 0.0003), y=41.36 + i * 0.0012 + rnd.uniform(-0.0003, 0.0003))
+
+    for i in range(side):
+        for j in range(side):
+            for di, dj in ((0, 1), (1, 0), (0, -1), (-1, 0)):
+                if 0 <= i + di < side and 0 <= j + dj < side and rnd.random() < 0.95:
+                    node1, node2 = i * side + j, (i + di) * side + j + dj
+                    dx = (graph.nodes[node1]['x'] - graph.nodes[node2]['x']) * 111320 * math.cos(math.radians(41.4))
+                    dy = (graph.nodes[node1]['y'] - graph.nodes[node2]['y']) * 110540
+                    data = {'length': math.hypot(dx, dy)}
+                    speed = rnd.choice(speeds)
+                    if speed is not None:
+                        data['maxspeed'] = speed
+                    graph.add_edge(node1, node2, **data)
+
+    return igo._prepare_graph(graph)
+
+
+# Trams sintetics sobre els carrers del graf: trossos de 5 nodes de les files i les columnes
+def _write_city_highways(filename, graph, side):
+
+    with open(filename, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Tram', 'Descripció', 'Coordenades'])
+
+        way_id = 1
+        for line in range(side):
+            for start in range(0, side - 4, 5):
+                for nodes in ([line * side + j for j in range(start, start + 5)], [i * side + line for i in range(start, start + 5)]):
+                    coordinates = [c for node in nodes for c in (graph.nodes[node]['x'], graph.nodes[node]['y'])]
+                    writer.writerow([way_id, 'Tram %d' % way_id, ','.join('%.6f' % c for c in coordinates)])
+                    way_id += 1
+
+    return way_id - 1
+
+
+# Dues congestions seguides dels trams: la segona canvia l'estat d'una fraccio "changed" dels trams
+def _write_city_congestions(filenames, ways, seed, changed):
+
+    rnd = random.Random(seed)
+    states = [(rnd.randint(0, 6), rnd.randint(0, 6)) for _ in range(ways)]
+
+    for data_hour, filename in zip((20210520101505, 20210520102005), filenames):
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write('Tram#Data#EstatActual#EstatPrevist\n')
+            for way_id, (state, next_state) in enumerate(states, 1):
+                file.write('%d#%d#%d#%d\n' % (way_id, data_hour, state, next_state))
+
+        states = [(rnd.randint(0, 6), rnd.randint(0, 6)) if rnd.random() < changed else state for state in states]
+
+
+# Tessel·les llises que cobreixen el graf a tots els zooms de staticmap, per pintar sense xarxa
+def _write_tiles(dirname, graph, size):
+
+    xs = [data['x'] for _, data in graph.nodes(data=True)]
+    ys = [data['y'] for _, data in graph.nodes(data=True)]
+    margin = size // 256 // 2 + 1
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (256, 256), (236, 234, 228)).save(buffer, format='PNG')
+    content = buffer.getvalue()
+
+    for zoom in range(18):
+        n = 2 ** zoom
+        tile_x = lambda lon: int((lon + 180) / 360 * n)
+        tile_y = lambda lat: int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+
+        for x in range(max(0, tile_x(min(xs)) - margin), min(n - 1, tile_x(max(xs)) + margin) + 1):
+            os.makedirs(os.path.join(dirname, str(zoom), str(x)), exist_ok=True)
+            for y in range(max(0, tile_y(max(ys)) - margin), min(n - 1, tile_y(min(ys)) + margin) + 1):
+                with open(os.path.join(dirname, str(zoom), str(x), '%d.png' % y), 'wb') as file:
+                    file.write(content)
+
+
+# Prepara els fitxers de la bateria de proves al directori indicat. Els que ja hi son no es toquen,
+# aixi s'hi poden deixar un graf i unes dades de l'Ajuntament enregistrades
+def _write_suite_fixture(dirname, side, seed):
+
+    graph_filename = os.path.join(dirname, SUITE_REGION + '.graph')
+    highways_filename = os.path.join(dirname, 'highways.csv')
+    congestions_filenames = [os.path.join(dirname, 'congestions.csv'), os.path.join(dirname, 'congestions_next.csv')]
+    tiles_dirname = os.path.join(dirname, 'tiles')
+
+    graph = None
+    if not os.path.exists(graph_filename):
+        graph = _synthetic_city(side, seed)
+        igo._save_graph(graph, graph_filename)
+
+    if not os.path.exists(highways_filename) or not os.path.exists(congestions_filenames[0]):
+        graph = graph or igo._load_graph(graph_filename)
+        ways = _write_city_highways(highways_filename, graph, side)
+        _write_city_congestions(congestions_filenames, ways, seed, SUITE_CHANGED)
+
+    if not os.path.exists(tiles_dirname):
+        _write_tiles(tiles_dirname, graph or igo._load_graph(graph_filename), igo.SIZE)
+
+    if not os.path.exists(congestions_filenames[1]):
+        congestions_filenames[1] = congestions_filenames[0]
+
+    return graph_filename, highways_filename, congestions_filenames, tiles_dirname
+
+
+# Commit actual del repositori (None si no es un repositori de git)
+def _git_commit():
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Mesures de la bateria de proves sobre la regio SUITE_REGION (el directori actual es el del fixture)
+def _run_suite(highways_filename, congestions_filenames, n, images, seed):
+
+    results = {}
+    feed_filename = os.path.abspath('congestions_feed.csv')
+    shutil.copyfile(congestions_filenames[0], feed_filename)
+    igo.register_region(SUITE_REGION, None, os.path.abspath(highways_filename), feed_filename)
+
+    # Graf: conversio del pickle al format binari, carrega del format binari i carrega de la regio
+    region = igo._region_config(SUITE_REGION)
+    results['graph_convert_ms'] = _timings(1, lambda: igo._convert_graph(region.graph_filename, region.binary_graph_dirname))[0]
+    results['graph_load_ms'] = _summary(_timings(SUITE_REPEAT, lambda: igo._load_binary_graph(region.binary_graph_dirname)))
+    results['system_load_ms'] = _timings(1, lambda: igo.start_system(SUITE_REGION))[0]
+
+    # Refrescos: el primer llegeix els trams i en fa l'index, el segon nomes aplica els trams que canvien
+    results['refresh_cold_ms'] = _timings(1, lambda: igo.refresh_igraph(SUITE_REGION))[0]
+    shutil.copyfile(congestions_filenames[1], feed_filename)
+    touched = []
+    results['refresh_incremental_ms'] = _timings(1, lambda: touched.append(igo.refresh_igraph(SUITE_REGION)))[0]
+    results['refresh_incremental_edges'] = touched[0]
+
+    # Construccio del igraph sencer a partir de les congestions
+    system = igo._load_system(SUITE_REGION)
+    csr = system['csr']
+    index = igo._get_tram_index(system, igo._get_highways(highways_filename))
+    congestions = igo._get_congestions(congestions_filenames[0])[1]
+    results['build_igraph_ms'] = _summary(_timings(SUITE_REPEAT, lambda: igo._build_igraph(csr, index, congestions)))
+
+    tracemalloc.start()
+    igo._build_igraph(csr, index, congestions)
+    results['build_igraph_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+
+    # Rutes sense imatge amb cada algorisme, per l'API publica. La primera consulta de cada algorisme es mesura
+    # a part (hi entren el preprocessat i la personalitzacio del CCH, les adjacencies...)
+    igraph = igo._get_igraph(SUITE_REGION)
+    results['cch_preprocess_ms'] = _timings(1, lambda: igo._get_cch(igraph.system))[0]
+    results['cch_customize_ms'] = _timings(1, lambda: igo._customize_cch(igo._get_cch(igraph.system), igraph.weights))[0]
+
+    pairs = _sample_pairs(csr, n, seed)
+    for mode in SUITE_MODES:
+        results['route_%s_first_ms' % mode] = _timings(1, lambda: igo.route(pairs[0][0], pairs[0][1], mode, SUITE_REGION))[0]
+        results['route_%s_ms' % mode] = _measure(pairs, lambda org, dest: igo.route(org, dest, mode, SUITE_REGION))
+
+    # Peticio sencera (cami, imatge i codificacio) i el pintat i la codificacio per separat, sense la cache d'imatges
+    with igo._renders_lock:
+        igo._renders.clear()
+    results['shortest_path_ms'] = _measure(pairs[:images], lambda org, dest: igo.shortest_path(org, dest, use_colors=True, region=SUITE_REGION))
+
+    paths = [route.path for route in (igo.route(org, dest, None, SUITE_REGION) for org, dest in pairs[:images]) if route is not None]
+    paths = [[csr.index[node] for node in path] for path in paths]
+    rendered = []
+    results['render_ms'] = _summary([_timings(1, lambda: rendered.append(igo._render_path(igraph, path, igo.SIZE, True)))[0] for path in paths])
+    results['encode_ms'] = _summary([_timings(1, lambda: igo._encode_image(image))[0] for image in rendered])
+
+    # Memoria: arrays residents del graf i maxim del proces (ru_maxrss es en KB a Linux i en bytes a macOS)
+    results['graph_mb'] = igo._system_bytes(system) / 2 ** 20
+    if resource is not None:
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+    return results, {'nodes': len(csr.nodes), 'edges': len(csr.targets), 'highways': len(index['edges']), 'signature': system['graph_signature']}
+
+
+# Bateria de proves reproduible: graf, trams, congestions i tessel·les fixes (generades amb "seed"
+# al directori "dirname" si no hi son) i consultes fixes. Els temps son en ms.
+# El resultat es un JSON que es pot comparar entre commits; es guarda a "filename" o es mostra per pantalla
+def benchmark_suite(filename=None, dirname=None, side=SUITE_SIDE, n=SUITE_QUERIES, images=SUITE_IMAGES, seed=SEED):
+
+    if dirname is None:
+        with tempfile.TemporaryDirectory() as dirname:
+            return benchmark_suite(filename, dirname, side, n, images, seed)
+
+    dirname = os.path.abspath(dirname)
+    os.makedirs(dirname, exist_ok=True)
+    _, highways_filename, congestions_filenames, tiles_dirname = _write_suite_fixture(dirname, side, seed)
+
+    # Els fitxers de la regio (graf binari, indexs, caches) es creen dins del directori del fixture
+    cwd, tile_url_template = os.getcwd(), igo.TILE_URL_TEMPLATE
+    os.chdir(dirname)
+    igo.TILE_URL_TEMPLATE = os.path.join(tiles_dirname, '{z}', '{x}', '{y}.png')
+
+    try:
+        results, fixture = _run_suite(highways_filename, congestions_filenames, n, images, seed)
+    finally:
+        os.chdir(cwd)
+        igo.TILE_URL_TEMPLATE = tile_url_template
+
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'queries': n,
+        'images': images,
+        'fixture': fixture,
+        'results': results,
+    }
+
+    if filename is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(filename, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    return report
+
+
+
+if __name__ == '__main__':
+
+    # python benchmark.py suite [resultat.json] [directori del fixture]
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        benchmark_suite(*sys.argv[2:4])
+        sys.exit()
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else N_QUERIES
+    benchmark_graph_service(n)
+    benchmark_graph_load()
+    benchmark_routing(n)
+    benchmark_batch(n)
+    benchmark_feeds()
+    benchmark_graph_preparation()
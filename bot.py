@@ -1,56 +1,64 @@
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Application, CommandHandler, MessageHandler, filters
 import igo
-import time
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
 
 
 
-# Declara una constant amb el access token que llegeix de token.txt
-TOKEN = open('token.txt').read().strip()
+# Segons entre dos refrescos de la congestio (compartit per tots els usuaris)
+CONGESTION_REFRESH_PERIOD = 300
 
 
-# Nom de les imatges
-POSITION_IMAGE = 'my_position.png'
-PATH_IMAGE = 'shortest_path.png'
+# Treballadors que calculen les rutes i pinten les imatges fora del bucle d'asyncio
+WORKER_TYPE = 'thread'			# 'thread' o 'process' (cada proces mapeja el mateix graf binari i els pesos que publica el bot, nomes lectura)
+WORKERS = os.cpu_count() or 1	# Nombre de treballadors
+MAX_PENDING_JOBS = 500			# Peticions en curs a partir de les quals es rebutgen les noves
+OVERLOAD_UPDATES = 50			# Actualitzacions que s'atenen alhora per sobre de MAX_PENDING_JOBS (nomes per respondre que es torni a provar)
 
 
-# Crea objectes per treballar amb Telegram
-updater = Updater(token=TOKEN, use_context=True)
-dispatcher = updater.dispatcher
+# Port local on es serveixen les metriques (/metrics, format de Prometheus). None per no servir-les
+METRICS_PORT = igo.METRICS_PORT
+
+
+# Peticions en curs de cada xat. Les d'un mateix xat s'atenen una darrere l'altra i en ordre
+# Nomes es fa servir des del bucle d'asyncio, no cal cap lock
+_jobs = {'executor': None, 'pending': 0, 'chats': {}}
 
 
 
 # Funcions del bot
 
 # Descarrega el graf si no ho esta
-def start(update, context):
+async def start(update, context):
 
-	# Inicialitzem el modul iGo
-	igo.start_system()
+	async def handle():
 
-	# Al inici utilitzarem sempre la ubicacio real
-	context.user_data['use_real_position'] = True
-	context.user_data['real_position'] = -1
-	context.user_data['false_position'] = -1
-	context.user_data['color_path'] = False
-	context.user_data['last_congestion_refresh'] = None
+		# Inicialitzem el modul iGo (nomes la primera vegada carrega el graf)
+		await asyncio.to_thread(igo.start_system)
 
-	########################################################################################################################
-	context.user_data['last_time_refresh'] = -1
-	########################################################################################################################
+		# Al inici utilitzarem sempre la ubicacio real
+		context.user_data['use_real_position'] = True
+		context.user_data['real_position'] = -1
+		context.user_data['false_position'] = -1
+		context.user_data['color_path'] = False
 
 
-	# Missatge que es mostrara
-	message = "Hola! Sóc el bot iGo!"
+		# Missatge que es mostrara
+		message = "Hola! Sóc el bot iGo!"
 
-	# Mostrem elm missatge
-	context.bot.send_message(
-		chat_id=update.effective_chat.id,
-		text=message)
+		# Mostrem elm missatge
+		await context.bot.send_message(
+			chat_id=update.effective_chat.id,
+			text=message)
+
+	await _submit(update, context, handle)
 
 
 
 # Mostra les comandes que es poden executar
-def help(update, context):
+async def help(update, context):
 
 	# Missatge que es mostrara
 	message = '''Aquí tens un llistat de les comandes que pots utilitzar:
@@ -67,20 +75,20 @@ def help(update, context):
 	'''
 
 	# Mostrem elm missatge
-	context.bot.send_message(
+	await context.bot.send_message(
 		chat_id=update.effective_chat.id,
 		text=message)
 
 
 
 # Mostra l'autor del bot
-def author(update, context):
+async def author(update, context):
 	
 	# Missatge que es mostrara
 	message = "Bot creat per Albert Rocafort. 05/2021"
 
 	# Mostrem elm missatge
-	context.bot.send_message(
+	await context.bot.send_message(
 		chat_id=update.effective_chat.id,
 		text=message)
 
@@ -88,154 +96,180 @@ def author(update, context):
 
 # Mostra una imatge amb el cami mes rapid desde la ubicacio actual de l'usuari fins el desti indicat
 # La ubicacio de origen tambe pot ser falsejada amb la comanda /pos
-def go(update, context):
+async def go(update, context):
 
-	# Agafem el desti que ens demanen del text del missatge i el passem a coordenades
-	
+	# Agafem el desti que ens demanen del text del missatge
 	try:
-		dest_lat, dest_lon = _get_coords_from_message(update, context, 2)
+		place = _get_place_from_message(update, context, 2)
+	except:
+		place = None
+
+	# Quan li toca el torn, agafem l'origen i el color (una /pos anterior ja s'ha aplicat)
+	async def handle():
+
+		if place is None:
+			await context.bot.send_message(
+				chat_id=update.effective_chat.id,
+				text="No s'ha pogut trobar el desti demanat")
+			return
 
 		# Ubicacio real com origen
 		if context.user_data['use_real_position'] == True:
 
 			# No tenim cap ubicacio guardada
-			if context.user_data['real_position'] == -1: result = 0	
-			
-			# Agafem la ubicacio que tenim guardada
-			else:
-				color = context.user_data['color_path']
-				org_lat, org_lon = context.user_data['real_position']
-
-				build_igraph = _need_to_build_igraph(context)
-
-				result = igo.shortest_path((org_lon, org_lat), (dest_lon, dest_lat), PATH_IMAGE, color, build_igraph)
+			if context.user_data['real_position'] == -1:
+				await context.bot.send_message(
+					chat_id=update.effective_chat.id,
+					text="Envia'm la teva localització o indica'n alguna amb la comanda /pos!")
+				return
 
+			org = context.user_data['real_position']
 
 		# Ubicacio falsejada com origen
 		else:
-			color = context.user_data['color_path']
-			org_lat, org_lon = context.user_data['false_position']
-
-			build_igraph = _need_to_build_igraph(context)
-
-			result = igo.shortest_path((org_lon, org_lat), (dest_lon, dest_lat), PATH_IMAGE, color, build_igraph)
-
+			org = context.user_data['false_position']
+
+		# Passem el desti a coordenades (pot ser una peticio al geocodificador, no ocupa cap treballador)
+		try:
+			with igo.span('geocode'):
+				dest = await asyncio.to_thread(_to_coords, place)
+		except Exception:
+			await context.bot.send_message(
+				chat_id=update.effective_chat.id,
+				text="No s'ha pogut trobar el desti demanat")
+			return
 
-		# Es decideix que ha de mostrar el bot en funcio del resultat obtingut anteriorment
-		if result == 1:		# S'ha trobat un cami correctament
-			context.bot.send_photo(
-			chat_id=update.effective_chat.id,
-			photo=open(PATH_IMAGE, 'rb'))
+		result = await _run(_go_job, org, dest, context.user_data['color_path'])
 
-		elif result == 0:	# No hi ha una ubicacio guardada
-			context.bot.send_message(
+		# Es decideix que ha de mostrar el bot en funcio del resultat obtingut pel treballador
+		if result == -1:	# No s'ha pogut trobar un cami
+			await context.bot.send_message(
 				chat_id=update.effective_chat.id,
-				text="Envia'm la teva localització o indica'n alguna amb la comanda /pos!")
+				text="No s'ha pogut trobar un cami entre l'origen i destí indicats")
 
-		elif result == -1:	# No s'ha pogut trobar un cami
-			context.bot.send_message(
+		else:	# S'ha trobat un cami correctament, tenim la imatge en memoria
+			with igo.span('telegram_send'):
+				await context.bot.send_photo(
 				chat_id=update.effective_chat.id,
-				text="No s'ha pogut trobar un cami entre l'origen i destí indicats")
+				photo=result)
 
-	except:
-		context.bot.send_message(
-			chat_id=update.effective_chat.id,
-			text="No s'ha pogut trobar el desti demanat")
+	await _submit(update, context, handle)
 
 
 # Si l'usuari ha falsejat la seva ubicacio, la mostra
 # Si l'usuari vol utilitzar la ubicacio real, demana que s'envii la ubicacio
-def where(update, context):
+async def where(update, context):
 
-	print(context.user_data['use_real_position'])
+	async def handle():
 
+		if context.user_data['use_real_position'] == True:	# Hem de mostrar la ubicacio real
 
-	if context.user_data['use_real_position'] == True:	# Hem de mostrar la ubicacio real
+			if context.user_data['real_position'] == -1:	# No hi ha una ubicacio guardada
+				await context.bot.send_message(
+				chat_id=update.effective_chat.id,
+				text="Envia'm la teva localització o indica'n alguna amb la comanda /pos!")
+				return
 
-		if context.user_data['real_position'] == -1:	# No hi ha una ubicacio guardada
-			context.bot.send_message(
-			chat_id=update.effective_chat.id,
-			text="Envia'm la teva localització o indica'n alguna amb la comanda /pos!")
+			position = context.user_data['real_position']	# Agafem la ubicacio que tenim guardada
 
-		else:	# Agafem la ubicacio que tenim guardada
-			lat, lon = context.user_data['real_position']
-			igo.show_position(lon, lat, POSITION_IMAGE)
-			context.bot.send_photo(
-				chat_id=update.effective_chat.id,
-				photo=open(POSITION_IMAGE, 'rb'))
+		else:	# Hem de mostrar la ubicacio falsa
+			position = context.user_data['false_position']
 
-	else:	# Hem de mostrar la ubicacio falsa
-		lat, lon = context.user_data['false_position']
-		igo.show_position(lon, lat, POSITION_IMAGE)
+		photo = await _run(_where_job, position)
 
-		context.bot.send_photo(
-			chat_id=update.effective_chat.id,
-			photo=open(POSITION_IMAGE, 'rb'))
-		
-	
+		with igo.span('telegram_send'):
+			await context.bot.send_photo(
+				chat_id=update.effective_chat.id,
+				photo=photo)
+
+	await _submit(update, context, handle)
 
 
 # Mostra la ubicacio real de l'usuari quan aquest envia la seva ubicacio
-def get_position(update, context):
+async def get_position(update, context):
 
 	# Codi per guardar la ubicacio a temps real
 	message = update.edited_message if update.edited_message else update.message
 
-	# Guardem la posicio que se'ns ha enviat en user_data
-	lat, lon = update.message.location.latitude, update.message.location.longitude
-	context.user_data['real_position'] = (lat, lon)
+	# Guardem la posicio que se'ns ha enviat en user_data (quan hagin acabat les peticions anteriors)
+	async def handle():
+		lat, lon = message.location.latitude, message.location.longitude
+		context.user_data['real_position'] = (lat, lon)
+
+	await _submit(update, context, handle)
 
 
 
 # Falseja la posicio
-def pos(update, context):
+async def pos(update, context):
 
-	# Obtenim les coordenades de la ubicacio indicada en el missatge
+	# Obtenim la ubicacio indicada en el missatge
 	try:
-		lat, lon = _get_coords_from_message(update, context, 3)
-	
-		# Guardem la posicio en user_data
-		context.user_data['use_real_position'] = False
-		context.user_data['false_position'] = (lat, lon)
-
+		place = _get_place_from_message(update, context, 3)
 	except:
-		context.bot.send_message(
-			chat_id=update.effective_chat.id,
-			text="No s'ha pogut trobar la posicio demanada")
+		place = None
+
+	async def handle():
+
+		try:
+			with igo.span('geocode'):
+				position = await asyncio.to_thread(_to_coords, place)
+		except Exception:
+			position = None
+
+		if position is None:
+			await context.bot.send_message(
+				chat_id=update.effective_chat.id,
+				text="No s'ha pogut trobar la posicio demanada")
+
+		else:	# Guardem la posicio en user_data
+			context.user_data['use_real_position'] = False
+			context.user_data['false_position'] = position
+
+	await _submit(update, context, handle)
 
 
 
 # Es deixa de falsejar la posicio
-def unpos(update, context):
-	
-    context.user_data['use_real_position'] = True
+async def unpos(update, context):
+
+	async def handle():
+		context.user_data['use_real_position'] = True
+
+	await _submit(update, context, handle)
 
 
 
 # Falseja la posicio
-def color(update, context):
+async def color(update, context):
 
 	# Activem l'us de colors alhora de mostrar la ruta
-	context.user_data['color_path'] = True
+	async def handle():
+		context.user_data['color_path'] = True
+
+	await _submit(update, context, handle)
 
 
 
 # Falseja la posicio
-def uncolor(update, context):
+async def uncolor(update, context):
 
 	# Activem l'us de colors alhora de mostrar la ruta
-	context.user_data['color_path'] = False
+	async def handle():
+		context.user_data['color_path'] = False
 
+	await _submit(update, context, handle)
 
 
 
 
-def _get_coords_from_message(update, context, comand_size):
+
+# Retorna el lloc indicat en el missatge: un text o una tupla (lat, lon)
+def _get_place_from_message(update, context, comand_size):
 
 	# Format string
 	if update.message.text[comand_size+2] < '0' or update.message.text[comand_size+2] > '9':
-		direction = update.message.text[comand_size+2:]
-		return igo.translate_direction(direction)
+		return update.message.text[comand_size+2:]
 
 	# Format coordenades 
 	else:
@@ -244,35 +278,174 @@ def _get_coords_from_message(update, context, comand_size):
 		return (float(lat), float(lon))
 
 
-def _need_to_build_igraph(context):
+# Passa un lloc (text o coordenades) a coordenades (lat, lon)
+def _to_coords(place):
+
+	if isinstance(place, str):
+		return igo.translate_direction(place)
+
+	return place
+
+
+
+# Feines que s'executen als treballadors (han de ser funcions de modul perque es puguin enviar a un proces)
+
+# Cami mes curt entre l'origen i el desti (lat, lon). Retorna la imatge (bytes) o -1 si no hi ha cami
+def _go_job(org, dest, color):
+
+	org_lat, org_lon = org
+	dest_lat, dest_lon = dest
+
+	result = igo.shortest_path((org_lon, org_lat), (dest_lon, dest_lat), use_colors=color)
+	return result if result == -1 else result.getvalue()
+
+
+# Imatge (bytes) de la posicio indicada
+def _where_job(position):
+
+	lat, lon = position
+	return igo.show_position(lon, lat).getvalue()
+
+
+# Inicialitza un proces treballador: no refresca la congestio, mapeja els pesos que publica el refresc del bot
+def _init_worker():
+
+	igo.start_system()
+	igo.follow_refresher()
+
+
+
+# Gestio de les peticions
+
+# Atén una peticio del xat quan hagin acabat les anteriors del mateix xat
+# Si hi ha massa peticions en curs es respon que es torni a provar mes tard
+async def _submit(update, context, handle):
+
+	chat_id = update.effective_chat.id
+
+	# Nom de la comanda (go, where, ...) per les metriques
+	name = handle.__qualname__.split('.')[0]
+
+	if _jobs['pending'] >= MAX_PENDING_JOBS:
+		igo.count('rejected_requests', handler=name)
+		await context.bot.send_message(
+			chat_id=chat_id,
+			text="Ara mateix tinc massa peticions, torna-ho a provar d'aquí a una estona")
+		return
+
+	# asyncio.Lock desperta les peticions que esperen en ordre d'arribada
+	chat = _jobs['chats'].setdefault(chat_id, {'lock': asyncio.Lock(), 'pending': 0})
+	chat['pending'] += 1
+	_jobs['pending'] += 1
 
-	t1 = context.user_data['last_congestion_refresh']
-	t2 = time.time()
+	try:
+		with igo.span('handler', handler=name):
+
+			with igo.span('chat_queue'):
+				await chat['lock'].acquire()
+
+			try:
+				await handle()
+			finally:
+				chat['lock'].release()
+
+	except Exception as error:
+		igo.count('failed_requests', handler=name)
+		print('Error atenent una peticio:', error)
+
+		# L'usuari sempre rep resposta (per exemple si falla el treballador o encara no ha fet /start)
+		try:
+			await context.bot.send_message(
+				chat_id=chat_id,
+				text="No s'ha pogut atendre la petició. Torna-ho a provar (si encara no ho has fet, comença amb /start)")
+		except Exception as error:
+			print('Error responent una peticio:', error)
+
+	finally:
+		_jobs['pending'] -= 1
+		chat['pending'] -= 1
+		if chat['pending'] == 0:
+			del _jobs['chats'][chat_id]
+
+
+# Executa una feina en un treballador sense bloquejar el bucle d'asyncio
+async def _run(job, *args):
+
+	with igo.span('worker', job=job.__name__):
+		return await asyncio.get_running_loop().run_in_executor(_jobs['executor'], job, *args)
+
+
+# Crea la pool de treballadors
+# La congestio es refresca un sol cop, al bot. Amb treballadors 'process' cada versio es publica a disc i els processos la segueixen
+# Els processos es creen de nou ('spawn'): amb fork heretarien l'estat del bot i els locks que tinguessin els seus fils
+def _start_workers():
+
+	if _jobs['executor'] is not None:
+		return
 
-	if t1 == None or t2 - t1 > 300:
-		context.user_data['last_congestion_refresh'] = t2
-		return True
+	igo.start_refresher(CONGESTION_REFRESH_PERIOD, shared=(WORKER_TYPE == 'process'))
 
-	return False
+	if WORKER_TYPE == 'process':
+		_jobs['executor'] = concurrent.futures.ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+	else:
+		_jobs['executor'] = concurrent.futures.ThreadPoolExecutor(WORKERS)
+
+
+# Atura la pool de treballadors
+def _stop_workers():
 
+	executor, _jobs['executor'] = _jobs['executor'], None
+	if executor is not None:
+		executor.shutdown()
 
-# Indica que quan el bot rebi la comanda s'executi la funció
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('help', help))
-dispatcher.add_handler(CommandHandler('author', author))
-dispatcher.add_handler(CommandHandler('go', go))
-dispatcher.add_handler(CommandHandler('where', where))
-dispatcher.add_handler(MessageHandler(Filters.location, get_position))
-dispatcher.add_handler(CommandHandler('pos', pos))
-dispatcher.add_handler(CommandHandler('unpos', unpos))
-dispatcher.add_handler(CommandHandler('color', color))
-dispatcher.add_handler(CommandHandler('uncolor', uncolor))
 
 
+# Crea l'aplicacio de Telegram amb tots els handlers
+# "base_url" permet fer servir un altre servidor de l'API (per exemple un de proves)
+# Amb "concurrent" a False s'atén una actualitzacio darrere l'altra, com feia l'antic Updater
+# Si no, la llibreria n'atén fins a MAX_PENDING_JOBS + OVERLOAD_UPDATES alhora: les que passen de MAX_PENDING_JOBS
+# es rebutgen de seguida a _submit i la resta esperen a la cua de la llibreria
+def build_application(token, base_url=None, concurrent=True):
 
+	builder = Application.builder().token(token).concurrent_updates(MAX_PENDING_JOBS + OVERLOAD_UPDATES if concurrent else False)
+	if base_url is not None:
+		builder = builder.base_url(base_url)
 
+	application = builder.build()
+
+	# Indica que quan el bot rebi la comanda s'executi la funció
+	application.add_handler(CommandHandler('start', start))
+	application.add_handler(CommandHandler('help', help))
+	application.add_handler(CommandHandler('author', author))
+	application.add_handler(CommandHandler('go', go))
+	application.add_handler(CommandHandler('where', where))
+	application.add_handler(MessageHandler(filters.LOCATION, get_position))
+	application.add_handler(CommandHandler('pos', pos))
+	application.add_handler(CommandHandler('unpos', unpos))
+	application.add_handler(CommandHandler('color', color))
+	application.add_handler(CommandHandler('uncolor', uncolor))
+
+	return application
 
 
 
 # Engega el bot
-updater.start_polling()
\ No newline at end of file
+def main():
+
+	# Declara una constant amb el access token que llegeix de token.txt
+	token = open('token.txt').read().strip()
+
+	# Carreguem el graf i engeguem els treballadors abans d'atendre peticions
+	_start_workers()
+
+	# Temps de cada etapa i comptadors de les caches (amb treballadors 'process' nomes hi ha les del bot)
+	if METRICS_PORT is not None:
+		igo.start_metrics_server(METRICS_PORT)
+
+	# Engega el bot
+	build_application(token).run_polling()
+
+
+
+if __name__ == '__main__':
+	main()
@@ -3,13 +3,31 @@ import osmnx as ox # Llibreria d'on descarregarem el mapa
 import collections # Llibreria per fer tuples
 import csv # Llibreria per llegir informació en format CSV
 import pickle # Llibreria per llegir/escriure dades de/en fitxers
+import sys
 import urllib # Llibreria per descarregar fitxers de la web
+import urllib.request
+import http.server # Llibreria per servir dades enregistrades en proves
 import haversine # Llibreria per calcular distancies entre coordenades
 import staticmap as sm # Llibreria per pintar mapes
 import os.path # Llibreria per comprovar si ja tenim el graf descarregat
-import sklearn # Llibreria per la funcio nearest_nodes
+import shutil
+import io # Llibreria per generar les imatges en memoria
+import hashlib # Llibreria per identificar la versio dels trams
+import json
+import unicodedata # Llibreria per normalitzar les consultes de geocodificacio
+import difflib # Llibreria per buscar els noms de carrer semblants
 import math
+import random
 import time
+import threading # Llibreria per protegir el graf resident entre peticions concurrents
+import heapq # Llibreria per la cua de prioritat de l'A*
+import bisect
+import contextlib # Llibreria per mesurar el temps de les etapes amb un "with"
+import functools # Llibreria per recordar les velocitats ja interpretades
+import numpy as np # Llibreria per guardar el graf en arrays compactes
+import scipy.sparse # Llibreria per fer Dijkstra sobre el graf compacte
+import scipy.sparse.csgraph
+import scipy.spatial # Llibreria per l'arbre KD dels nodes mes propers
 
 
 
@@ -17,21 +35,96 @@ import time
 # Constants
 PLACE = 'Barcelona, Catalonia'
 GRAPH_FILENAME = 'barcelona.graph'
-IGRAPH_FILENAME = 'barcelona_i.graph'
+BINARY_GRAPH_DIRNAME = 'barcelona_graph' # Graf en format binari (arrays que es carreguen amb memmap)
+WEIGHTS_DIRNAME = 'barcelona_weights' # Pesos publicats pel proces que refresca, pels processos que el segueixen (veure follow_refresher)
+TRAM_INDEX_FILENAME = 'barcelona_trams.index'
+CCH_FILENAME = 'barcelona.cch'
+STREET_INDEX_FILENAME = 'barcelona_streets.index' # Noms de carrer del graf amb la seva posicio (geocodificador local)
+POI_FILENAME = 'pois.csv' # Llocs d'interes opcionals pel geocodificador local (columnes name, lat, lon)
+CCH_LEAF_SIZE = 4 # Regions de la disseccio niada que ja no es parteixen
 SIZE = 800
+TILE_URL_TEMPLATE = 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png' # URL de les tessel·les o directori local ({z}/{x}/{y}.png)
+TILE_CACHE_DIRNAME = 'tiles_cache' # Cache de disc de les tessel·les descarregades
+TILE_CACHE_SIZE = 200 * 1024 * 1024 # Mida maxima (bytes) de la cache de tessel·les
+RENDER_CACHE_SIZE = 64 # Nombre maxim d'imatges de rutes (ja codificades) guardades en memoria
+IMAGE_FORMAT = 'PNG' # Format de les imatges que es retornen en memoria ('PNG' o 'JPEG')
+IMAGE_COMPRESS_LEVEL = 1 # Compressio PNG (0-9): les imatges es generen a cada peticio, millor rapid
+IMAGE_QUALITY = 85 # Qualitat JPEG (1-95)
+GEOCODE_CACHE_FILENAME = 'geocode_cache.json' # Cache persistent de les direccions ja traduides
+GEOCODE_TTL = 30 * 24 * 3600 # Segons que es fa servir una direccio traduida abans de tornar-la a demanar
+GEOCODE_NEGATIVE_TTL = 3600 # Segons que es recorda que una direccio no s'ha trobat
+GEOCODE_MIN_PREFIX = 4 # Lletres minimes per acceptar un nom de carrer que comenci per la consulta
+GEOCODE_FUZZY_CUTOFF = 0.85 # Semblanca minima (0-1) per acceptar un nom de carrer mal escrit
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+FEED_CACHE_DIRNAME = 'feeds_cache' # Darrera copia descarregada de les dades de l'Ajuntament
+FEED_TIMEOUT = 30 # Segons maxims d'espera de les dades de l'Ajuntament
+MATRIX_CHUNK = 64 # Origens que es calculen alhora a la matriu de temps (cada un ocupa un array per node)
+MAX_REPORTED_ROWS = 10 # Linies incorrectes de les dades de l'Ajuntament que es mostren (les URL tambe poden ser fitxers locals)
+
+REFRESH_PERIOD = 300 # Segons entre dos refrescos de la congestio
+FOLLOW_PERIOD = 5 # Segons entre dues comprovacions de pesos nous als processos que segueixen el refresc d'un altre
+DEFAULT_REGION = 'barcelona' # Regio dels fitxers i URL d'aqui dalt, es fa servir si l'origen no cau dins de cap altra
+REGIONS_FILENAME = 'regions.json' # Regions addicionals: llista de {name, place, highways_url, congestions_url, refresh_period, bbox}
+REGION_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024 # Bytes maxims dels grafs de les regions carregades
+REGION_IDLE_TIME = 3600 # Segons sense consultes a partir dels quals es descarrega una regio
+METRICS_PORT = 9464 # Port del servidor local de metriques (format de text de Prometheus)
+METRICS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30] # Limits (segons) dels histogrames
+ROUTING_MODE = 'dijkstra' # Algorisme per defecte per buscar el cami mes curt: 'dijkstra', 'bidijkstra', 'astar', 'cch' o 'tdijkstra'
+FORECAST_HORIZON = 15 * 60 # Segons del trajecte (a la velocitat de cada via, com Route.time) a partir dels quals val l'EstatPrevist
+
+ASTAR_MARGIN = 0.999 # Marge sobre l'heuristica de l'A* pels arrodoniments de les longituds
 
 GENERIC_SPEED = 30
 GENERIC_CONGESTION = 3
+TIME_UNIT_SECONDS = 3.6 # Segons d'una unitat de 'time' (metres / (km/h))
 
 GREEN_STREETS = [1, 2]
 ORANGE_STREETS = [3, 4]
 RED_STREEETS = [5]
 
+STREET_TYPES = ['carrer', 'avinguda', 'passeig', 'plaça', 'rambla', 'ronda', 'travessera', 'passatge', 'via', 'camí', 'baixada', 'pujada', 'carretera', 'calle', 'avenida', 'paseo', 'plaza']
+STREET_LINKS = ['de les ', 'de los ', 'de la ', 'del ', 'dels ', 'de ', "d'", 'd’']
+
 # Definicio de tuples
 Highway = collections.namedtuple('Highway', 'description coordinates') # Tram
 Congestion = collections.namedtuple('Congestion', 'state next_state')
+CSR = collections.namedtuple('CSR', 'nodes index x y offsets targets length time itime congestion') # Graf compacte
+BINARY_GRAPH_FIELDS = ['nodes', 'x', 'y', 'offsets', 'targets', 'length', 'time', 'itime', 'congestion'] # Arrays del CSR que es guarden a disc
+Weights = collections.namedtuple('Weights', 'congestion itime next_itime') # Pesos de congestio per aresta del CSR (actual i prevista)
+CCH = collections.namedtuple('CCH', 'rank parent up_offsets up_heads arc_tails triangles edge_arcs edge_up') # Jerarquia de contraccio
+CCHMetric = collections.namedtuple('CCHMetric', 'up down mid_up mid_down') # Pesos de la jerarquia per uns pesos del CSR
+IGraph = collections.namedtuple('IGraph', 'csr weights matrix min_cost cch version system') # Graf base + pesos publicats + estat de la regio
+Region = collections.namedtuple('Region', 'place graph_filename binary_graph_dirname weights_dirname tram_index_filename cch_filename street_index_filename poi_filename highways_url congestions_url refresh_period bbox') # Fitxers i dades d'una regio
+Route = collections.namedtuple('Route', 'time cost distance path') # Segons (a la velocitat de cada via), cost amb congestio (itime), metres i nodes d'OSM d'un cami
+
+# Error del geocodificador quan no troba una direccio. A osmnx 2 els errors HTTP del servidor tambe son ValueError,
+# nomes es pot fer servir ValueError a les versions que no tenen InsufficientResponseError
+_GEOCODE_NOT_FOUND = getattr(getattr(ox, '_errors', None), 'InsufficientResponseError', ValueError)
+
+# Congestions possibles (estats 0-6) a partir del text dels estats
+_CONGESTIONS = {(str(state), str(next_state)): Congestion(state, next_state) for state in range(7) for next_state in range(7)}
+
+
+# Estat del sistema: el graf base i el igraph actual es mantenen en memoria
+# mentre la regio estigui carregada. El graf base no es modifica mai: la congestio
+# es guarda en uns arrays de pesos a part (un valor per aresta del CSR) que
+# una actualitzacio copia, modifica i substitueix de forma atomica.
+# Cada regio te el seu estat, "_system" es el de la regio per defecte (no es descarrega mai).
+_tiles_lock = threading.Lock()
+_tiles = {'files': None, 'size': 0} # Fitxers de la cache de tessel·les en ordre d'us (LRU) i mida total
+_renders_lock = threading.Lock()
+_renders = collections.OrderedDict() # Imatges de rutes ja pintades i codificades, en bytes (LRU)
+_streets_lock = threading.Lock()
+_geocodes_lock = threading.Lock()
+_geocodes = {'entries': None, 'hits': 0, 'misses': 0} # Consulta normalitzada -> [lat, lon] (o None) i quan es va demanar
+_system = {'name': DEFAULT_REGION, 'lock': threading.Lock(), 'refresh_lock': threading.Lock(), 'cch_lock': threading.Lock(), 'stop_refresher': threading.Event(), 'last_used': 0.0, 'bbox': None, 'graph_signature': None, 'csr': None, 'igraph': None, 'version': 0, 'refresher': None, 'tram_index': None, 'highways': None, 'street_index': None, 'tree': None, 'reverse': None, 'forecast': None, 'cch': None, 'cch_metric': None, 'applied': None, 'shared': None, 'edges_touched': 0}
+_regions_lock = threading.Lock()
+_regions = {DEFAULT_REGION: _system} # Estat de les regions que s'han fet servir
+_region_configs = {'loaded': False, 'regions': {}} # Regions registrades (a mes de la de per defecte)
+_refreshers = {'period': None, 'shared': False, 'follow': False} # Periode dels fils de refresc (None si no s'han d'engegar), si es publiquen els pesos i si se segueixen
+_metrics_lock = threading.Lock()
+_metrics = {'histograms': {}, 'counters': {}, 'gauges': {}, 'server': None} # (nom, etiquetes) -> valor
 
 
 
@@ -42,53 +135,288 @@ Congestion = collections.namedtuple('Congestion', 'state next_state')
 
 
 # Inicialitza les dades del sistema
-def start_system():
+# Carrega el graf base de la regio (per defecte DEFAULT_REGION) un sol cop, les crides posteriors no fan res
+def start_system(region=None):
+
+    _load_system(region or DEFAULT_REGION)
+
+
+# Torna a calcular el igraph de la regio amb les congestions actuals i el publica
+# Retorna el nombre d'arestes actualitzades
+def refresh_igraph(region=None):
+
+    return _refresh_system(_load_system(region or DEFAULT_REGION))
+
+
+# Engega fils en segon pla que refresquen la congestio de cada regio carregada cada "period" segons
+# (o el periode propi de la regio). Les regions que es carreguen mes tard engeguen el seu fil en carregar-se
+# Les peticions no esperen mai el refresc, fan servir el darrer igraph publicat
+# Amb "shared" cada versio publicada tambe es guarda a disc perque altres processos la mapegin sense refrescar
+# (veure follow_refresher), i es carreguen les regions que aquests processos fan servir
+def start_refresher(period=REFRESH_PERIOD, shared=False):
+
+    with _regions_lock:
+        _refreshers.update(period=period, shared=shared, follow=False)
+
+    _start_refreshers()
+
+
+# Com start_refresher, pero en lloc de refrescar la congestio els fils fan servir els pesos que publica un altre proces
+# (el que ha cridat start_refresher amb "shared"). Cada "period" segons miren si n'hi ha una versio nova i la mapegen
+def follow_refresher(period=FOLLOW_PERIOD):
+
+    with _regions_lock:
+        _refreshers.update(period=period, shared=False, follow=True)
+
+    _start_refreshers()
+
+
+# Atura els fils de refresc
+def stop_refresher():
+
+    with _regions_lock:
+        _refreshers.update(period=None, shared=False, follow=False)
+        systems = list(_regions.values())
 
-    # Descarreguem / Carreguem el graf
-    if not _exists_graph(GRAPH_FILENAME):
-        graph = _download_graph(PLACE)
-        save_graph(graph)
+    for system in systems:
+        _stop_system_refresher(system)
+
+
+# Registra una regio (una ciutat o area) amb el seu graf i, si en te, les seves dades de congestio
+# Els fitxers es diuen com la regio. No es carrega fins que una consulta no la fa servir
+# "bbox" es (oest, sud, est, nord): permet escollir la regio per l'origen abans de carregar-la
+def register_region(name, place, highways_url=None, congestions_url=None, refresh_period=None, bbox=None):
+
+    region = _make_region(name, place, highways_url, congestions_url, refresh_period, bbox)
+
+    with _regions_lock:
+        _region_configs['regions'][name] = region
 
 
 # Mostra la posició real de l'usuari
-def show_position(lon, lat, image_name):
+# Si no es dona "image_name" es retorna la imatge codificada en un BytesIO
+def show_position(lon, lat, image_name=None, image_format=None, compress_level=None):
 
-    _plot_position(lon, lat, SIZE, image_name)
+    with span('render_position'):
+        image = _plot_position(lon, lat, SIZE)
+
+    if image_name is not None:
+        image.save(image_name)
+        return 1
+
+    return _encode_image(image, image_format, compress_level)
 
 
 # Desde la posició real o falsejada es retorna una imatge amb el cami mes curt fins el desti
-def shortest_path(org, dest, image_name, use_colors, build_igraph):
+# "mode" es l'algorisme de cerca ('dijkstra', 'bidijkstra', 'astar', 'cch' o 'tdijkstra'), per defecte ROUTING_MODE
+# Amb 'tdijkstra' els trams on s'entra despres de FORECAST_HORIZON es pesen amb la congestio prevista
+# "region" es la regio on es busca el cami, per defecte la que conte l'origen
+# Si no es dona "image_name" es retorna la imatge codificada en un BytesIO (-1 si no hi ha cami)
+def shortest_path(org, dest, image_name=None, use_colors=False, build_igraph=False, mode=None, image_format=None, compress_level=None, region=None):
 
+    # La regio es la que conte l'origen, si no se'n indica cap
+    region = region or _region_at(*org)
 
+    # Obtenir graf, highways i congestions i publicar el nou igraph
     if build_igraph:
-        #Obtenir graf, highways i congestions, crea igraph i guardarlo
-        graph = _get_graph(GRAPH_FILENAME)
-        highways = _get_highways()
-        congestions = _get_congestions()
-        _build_igraph(graph, highways, congestions)
-        _save_graph(graph, IGRAPH_FILENAME)
+        refresh_igraph(region)
 
-    else:
-        graph = _get_graph(IGRAPH_FILENAME)
+    # Agafem la versio actual del igraph, es la mateixa durant tota la peticio
+    with span('graph', region=region):
+        igraph = _get_igraph(region)
 
-    # Busquem els nodes origen i desti
-    org_node = ox.distance.nearest_nodes(graph, org[0], org[1])
-    dest_node = ox.distance.nearest_nodes(graph, dest[0], dest[1])
+    # Busquem els nodes origen i desti (posicio dins del CSR)
+    with span('nearest_nodes', region=region):
+        org_node, dest_node = _nearest_nodes(igraph.system, [org[0], dest[0]], [org[1], dest[1]])
 
     # Buscar cami més curt
-    ipath = _get_shortest_ipath(graph, org_node, dest_node)
+    with span('shortest_path', region=region, mode=mode or ROUTING_MODE):
+        ipath = _get_shortest_ipath(igraph, org_node, dest_node, mode)
+
+    if ipath == None:
+        count('paths', result='none')
+        return -1
+
+    count('paths', result='found')
+
+    if image_name is not None:
+        _render_path(igraph, ipath, SIZE, use_colors).save(image_name)
+        return 1
+
+    # Genera la imatge codificada (si ja l'hem pintat abans amb la mateixa congestio i format, es reaprofita)
+    with span('render', region=region):
+        return io.BytesIO(_plot_path(igraph, ipath, SIZE, use_colors, image_format, compress_level))
+
+
+# Cami mes curt entre dos punts (lon, lat) sense pintar cap imatge
+# Retorna un Route o None si no hi ha cami. Si no s'indica la regio es la que conte l'origen
+def route(org, dest, mode=None, region=None):
+
+    igraph = _get_igraph(region or _region_at(*org))
+    org_node, dest_node = _nearest_nodes(igraph.system, [org[0], dest[0]], [org[1], dest[1]])
+
+    return _make_route(igraph, _get_shortest_ipath(igraph, org_node, dest_node, mode), mode)
 
-    if ipath == None: return -1
 
-    # Guarda la imatge
-    _plot_path(graph, ipath, SIZE, image_name, use_colors)
-    return 1
+# Camins mes curts des d'un origen fins a cada un dels destins (lon, lat) amb un sol Dijkstra
+# Retorna una llista amb un Route (o None si no hi ha cami) per cada desti, en el mateix ordre
+def routes(org, dests, region=None):
+
+    igraph = _get_igraph(region or _region_at(*org))
+    nodes = _nearest_nodes(igraph.system, [org[0]] + [dest[0] for dest in dests], [org[1]] + [dest[1] for dest in dests])
+
+    dist, pred = scipy.sparse.csgraph.dijkstra(igraph.matrix, indices=nodes[0], return_predecessors=True)
+
+    return [None if dist[node] == math.inf else _make_route(igraph, _predecessor_path(pred, nodes[0], node)) for node in nodes[1:]]
+
+
+# Matriu de temps (en segons, com Route.time) dels camins mes curts entre cada origen i cada desti (llistes de punts (lon, lat))
+# Retorna un array de numpy de mida len(orgs) x len(dests), amb inf on no hi ha cami
+# Tots els punts han de ser de la mateixa regio, per defecte la que conte el primer origen
+def travel_time_matrix(orgs, dests, region=None):
+
+    igraph = _get_igraph(region or _region_at(*orgs[0]))
+    org_nodes = _nearest_nodes(igraph.system, [org[0] for org in orgs], [org[1] for org in orgs])
+    dest_nodes = _nearest_nodes(igraph.system, [dest[0] for dest in dests], [dest[1] for dest in dests])
+
+    # Un Dijkstra per cada node origen diferent, de MATRIX_CHUNK en MATRIX_CHUNK
+    csr = igraph.csr
+    tails = np.repeat(np.arange(len(csr.nodes)), np.diff(csr.offsets))
+    sources = sorted(set(org_nodes))
+    rows = {}
+    for start in range(0, len(sources), MATRIX_CHUNK):
+        chunk = sources[start:start + MATRIX_CHUNK]
+        dist, pred = scipy.sparse.csgraph.dijkstra(igraph.matrix, indices=chunk, return_predecessors=True)
+        rows.update((node, _tree_seconds(csr, tails, dist[i], pred[i])[dest_nodes]) for i, node in enumerate(chunk))
+
+    return np.array([rows[node] for node in org_nodes]).reshape(len(orgs), len(dests))
 
 
 # Tradueix una direccio de string a coordenades
-def translate_direction(direction):
+# Primer es busca entre els carrers del graf de la regio (i els seus llocs d'interes) sense sortir del proces.
+# Si no hi es, es demana al geocodificador i la resposta (tambe si no es troba) es guarda en una cache persistent
+def translate_direction(direction, region=None):
+
+    query = _normalize_query(direction)
+
+    with span('local_geocode'):
+        point = _local_geocode(query, region or DEFAULT_REGION)
+
+    count('geocode', source='local' if point is not None else 'remote')
+    if point is not None:
+        return point
+
+    now = time.time()
+
+    with _geocodes_lock:
+        entry = _geocode_entries().get(query)
+        if entry is not None and _geocode_alive(entry, now):
+            _geocodes['hits'] += 1
+            hit = entry['point']
+        else:
+            _geocodes['misses'] += 1
+            entry = None
+
+    count('geocode_cache', result='hit' if entry is not None else 'miss')
+
+    if entry is not None:
+        if hit is None:
+            raise ValueError('No s\'ha trobat la direccio %r' % direction)
+        return tuple(hit)
+
+    # Els errors de xarxa i del servidor (per exemple un 429) no es guarden, nomes les direccions que el geocodificador no troba
+    try:
+        with span('geocoder'):
+            point = ox.geocoder.geocode(direction)
+    except _GEOCODE_NOT_FOUND:
+        _put_geocode(query, None, now)
+        raise
+
+    _put_geocode(query, point, now)
+    return point
+
+
+# Encerts i fallades de la cache de geocodificacio
+def geocode_stats():
+
+    with _geocodes_lock:
+        return {'hits': _geocodes['hits'], 'misses': _geocodes['misses'], 'entries': len(_geocode_entries())}
+
+
+# Mesura el temps d'una etapa (with span('render'): ...) i l'afegeix a l'histograma igo_stage_seconds
+@contextlib.contextmanager
+def span(stage, **labels):
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(stage, time.perf_counter() - t0, labels)
+
+
+# Suma "value" al comptador igo_<name>_total
+def count(name, value=1, **labels):
+
+    key = (name, tuple(sorted(labels.items())))
+
+    with _metrics_lock:
+        _metrics['counters'][key] = _metrics['counters'].get(key, 0) + value
+
+
+# Retorna totes les metriques en el format de text de Prometheus
+def metrics_text():
 
-    return ox.geocoder.geocode(direction)
+    lines = []
+
+    with _metrics_lock:
+        histograms = sorted(_metrics['histograms'].items())
+        counters = sorted(_metrics['counters'].items())
+        gauges = sorted(_metrics['gauges'].items())
+
+        if histograms:
+            lines.append('# TYPE igo_stage_seconds histogram')
+        for labels, histogram in histograms:
+            total = 0
+            for limit, n in zip(METRICS_BUCKETS, histogram['buckets']):
+                total += n
+                lines.append('igo_stage_seconds_bucket%s %d' % (_format_labels(labels + (('le', repr(float(limit))),)), total))
+            lines.append('igo_stage_seconds_bucket%s %d' % (_format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+            lines.append('igo_stage_seconds_sum%s %r' % (_format_labels(labels), histogram['sum']))
+            lines.append('igo_stage_seconds_count%s %d' % (_format_labels(labels), histogram['count']))
+
+        for kind, suffix, values in (('counter', '_total', counters), ('gauge', '', gauges)):
+            for name in sorted({name for (name, _), _ in values}):
+                lines.append('# TYPE igo_%s%s %s' % (name, suffix, kind))
+                lines.extend('igo_%s%s%s %r' % (name, suffix, _format_labels(labels), value) for (other, labels), value in values if other == name)
+
+    return '\n'.join(lines) + '\n'
+
+
+# Engega un servidor HTTP local que serveix metrics_text() (a /metrics) en un fil en segon pla
+def start_metrics_server(port=METRICS_PORT, host='127.0.0.1'):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            content = metrics_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    with _metrics_lock:
+        if _metrics['server'] is not None:
+            return _metrics['server']
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        _metrics['server'] = server
+
+    threading.Thread(target=server.serve_forever, name='igo-metrics', daemon=True).start()
+    return server
 
 
 ###################################################################
@@ -96,53 +424,378 @@ def translate_direction(direction):
 ###################################################################
 
 
-# Descarrega archiu CSV de internet
-def _download_csv(url):
+# Llegeix un CSV d'internet (o d'un fitxer local, si "source" no es una URL) linia a linia
+# Es decodifica a mesura que arriba, sense guardar tota la resposta. Retorna (numero de linia, camps)
+def _read_csv(source):
+
+    with _open_feed(source) as stream:
+        text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace', newline='')
+        reader = csv.reader(text, delimiter=',', quotechar='"')
+        next(reader, None)  # ignore first line with description
+
+        for line in reader:
+            yield reader.line_num, line
+
+
+# Com _read_csv, per fitxers sense cometes on n'hi ha prou de partir cada linia pel separador
+def _read_separated(source, separator):
+
+    with _open_feed(source) as stream:
+        text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+        next(text, None)  # ignore first line with description
+
+        for line_num, line in enumerate(text, 2):
+            if line.strip():
+                yield line_num, line.rstrip('\r\n').split(separator)
+
+
+# Obre una font de dades: una URL o el cami d'un fitxer local (per exemple dades enregistrades)
+def _open_feed(source):
+
+    if '://' in source:
+        return urllib.request.urlopen(source, timeout=FEED_TIMEOUT)
+
+    return open(source, 'rb')
+
+
+# Porta una URL a la cache de disc i retorna el fitxer local (un cami local es retorna tal qual)
+# Es fa una peticio condicional (ETag / Last-Modified): si no ha canviat, el servidor no torna a enviar les dades
+# Si el servidor no respon o falla (error 5xx) es fa servir la darrera copia
+def _fetch_feed(source):
+
+    if '://' not in source:
+        return source
+
+    os.makedirs(FEED_CACHE_DIRNAME, exist_ok=True)
+    filename = os.path.join(FEED_CACHE_DIRNAME, hashlib.sha1(source.encode('utf-8')).hexdigest())
+
+    meta = {}
+    if os.path.exists(filename) and os.path.exists(filename + '.json'):
+        with open(filename + '.json') as file:
+            meta = json.load(file)
+
+    headers = {}
+    if meta.get('etag'): headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'): headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        with span('feed_download'), urllib.request.urlopen(urllib.request.Request(source, headers=headers), timeout=FEED_TIMEOUT) as response:
+            tmp_filename = _tmp_filename(filename)
+            with open(tmp_filename, 'wb') as file:
+                shutil.copyfileobj(response, file)
+            os.replace(tmp_filename, filename)
+
+            meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            tmp_filename = _tmp_filename(filename + '.json')
+            with open(tmp_filename, 'w') as file:
+                json.dump(meta, file)
+            os.replace(tmp_filename, filename + '.json')
+
+        count('feed_fetches', status='downloaded')
+
+    except urllib.error.HTTPError as error:
+        if (error.code != 304 and error.code < 500) or not meta:
+            raise
+        if error.code == 304:
+            count('feed_fetches', status='not_modified')
+        else:
+            count('feed_fetches', status='failed')
+            print('No s\'ha pogut descarregar %s, es fa servir la copia guardada: %s' % (source, error))
+
+    except (urllib.error.URLError, OSError) as error:
+        if not meta:
+            raise
+        count('feed_fetches', status='failed')
+        print('No s\'ha pogut descarregar %s, es fa servir la copia guardada: %s' % (source, error))
+
+    return filename
+
+
+# Mostra les linies d'una font que no s'han pogut llegir (com a molt MAX_REPORTED_ROWS)
+def _report_malformed(source, malformed):
 
-    with urllib.request.urlopen(url) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
-        next(reader)  # ignore first line with description
-        
-        return reader
+    if not malformed:
+        return
+
+    print('%d linies incorrectes a %s' % (len(malformed), source))
+    for line_num, reason in malformed[:MAX_REPORTED_ROWS]:
+        print('  linia %d: %s' % (line_num, reason))
 
 
 # Retorna una llista amb tots els Highways
-def _get_highways():
-    
-    # Llegim els Highways de la URL
-    csv_reader = _download_csv(HIGHWAYS_URL)
+def _get_highways(source=None):
+
+    source = source or HIGHWAYS_URL
 
     # Diccionari per emmagatzemar els highways
     highways = {}
+    malformed = []
+
+    # Iterem per totes les linies a mesura que es llegeixen
+    for line_num, line in _read_csv(source):
 
-    # Iterem per tot el reader
-    for line in csv_reader:
+        try:
+            way_id, description, coordinates = line
+            coordinates = [float(c) for c in coordinates.split(',')]
+            if len(coordinates) < 4 or len(coordinates) % 2 != 0:
+                raise ValueError('%d coordenades' % len(coordinates))
 
-        # Guardem la info al diccionari
-        way_id, description, coordinates = line
-        highways[int(way_id)] = Highway(description, list(map(float, coordinates.split(','))))
+            # Guardem la info al diccionari
+            highways[int(way_id)] = Highway(description, coordinates)
 
+        except ValueError as error:
+            malformed.append((line_num, error))
 
+    _report_malformed(source, malformed)
     return highways
 
 
-# Retorna una llista amb tots els Congestions
-def _get_congestions():
-    
-    csv_reader = _download_csv(CONGESTIONS_URL)
+# Retorna els Highways d'un fitxer local de la regio, sense tornar-lo a llegir si no ha canviat des del darrer cop
+def _get_cached_highways(system, filename):
+
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+
+    cached = system['highways']
+    if cached is None or cached['key'] != key:
+        cached = {'key': key, 'highways': _get_highways(filename)}
+        system['highways'] = cached
+
+    return cached['highways']
+
+
+# Retorna la data de les dades (data_hour mes recent, AAAAMMDDhhmmss) i una llista amb tots els Congestions
+def _get_congestions(source=None):
+
+    source = source or CONGESTIONS_URL
 
+    data_hour = 0
     congestions = {}
+    malformed = []
+
+    # Cada linia es "way_id#data_hour#state#next_state"
+    for line_num, line in _read_separated(source, '#'):
+
+        try:
+            way_id, data_hour_text, state, next_state = line
+
+            # Nomes hi ha 7 x 7 congestions possibles, es reaprofiten en lloc de convertir els estats
+            congestion = _CONGESTIONS.get((state, next_state))
+            if congestion is None:
+                raise ValueError('estat %r, %r incorrecte' % (state, next_state))
+
+            # Guardem la info al diccionari
+            congestions[int(way_id)] = congestion
+            data_hour = max(data_hour, int(data_hour_text))
+
+        except ValueError as error:
+            malformed.append((line_num, error))
+
+    _report_malformed(source, malformed)
+    return data_hour, congestions
+
+
+
+
+############################################################
+##### Funcions Privades per la Cache de Geocodificacio #####
+############################################################
+
+
+# Consulta normalitzada: mateixes direccions escrites diferent comparteixen entrada
+def _normalize_query(direction):
+
+    return ' '.join(unicodedata.normalize('NFC', direction).casefold().split())
+
+
+# Entrades de la cache, es carreguen de disc el primer cop. Cal tenir _geocodes_lock
+def _geocode_entries():
 
-    # Iterem per tot el reader
-    # (O(len(csv_reader)) < 550)
-    for line in csv_reader:
+    if _geocodes['entries'] is None:
+        try:
+            with open(GEOCODE_CACHE_FILENAME, 'r', encoding='utf-8') as file:
+                _geocodes['entries'] = json.load(file)
+        except (OSError, ValueError):
+            _geocodes['entries'] = {}
+
+    return _geocodes['entries']
+
+
+# Indica si una entrada de la cache encara no ha caducat
+def _geocode_alive(entry, now):
+
+    ttl = GEOCODE_TTL if entry['point'] is not None else GEOCODE_NEGATIVE_TTL
+    return now - entry['time'] < ttl
+
+
+# Guarda una resposta del geocodificador (None si no s'ha trobat) i reescriu el fitxer
+def _put_geocode(query, point, now):
+
+    with _geocodes_lock:
+        entries = _geocode_entries()
+        entries[query] = {'point': None if point is None else list(point), 'time': now}
+
+        # Les entrades caducades no es guarden
+        entries = {key: entry for key, entry in entries.items() if _geocode_alive(entry, now)}
+        _geocodes['entries'] = entries
+
+        tmp_filename = _tmp_filename(GEOCODE_CACHE_FILENAME)
+        try:
+            with open(tmp_filename, 'w', encoding='utf-8') as file:
+                json.dump(entries, file, ensure_ascii=False)
+            os.replace(tmp_filename, GEOCODE_CACHE_FILENAME)
+        except OSError as error:
+            print('No s\'ha pogut guardar la cache de geocodificacio:', error)
+
+
+
+
+######################################################
+##### Funcions Privades pel Geocodificador Local #####
+######################################################
+
+
+# Busca una consulta ja normalitzada entre els noms de carrer i llocs d'interes
+# Primer el nom exacte, despres un nom que comenci per la consulta i finalment el nom mes semblant
+# Retorna (lat, lon) o None. Les consultes amb numeros (adreces) les resol el geocodificador
+def _local_geocode(query, region):
+
+    query = _strip_city(query)
+    if not query or any(c.isdigit() for c in query):
+        return None
+
+    index = _get_street_index(_load_system(region))
+    places, names = index['places'], index['names']
+
+    if query in places:
+        return places[query]
+
+    # El nom mes curt que comenci per la consulta ("passeig de gr" -> "passeig de gràcia")
+    if len(query) >= GEOCODE_MIN_PREFIX:
+        i = bisect.bisect_left(names, query)
+        candidates = []
+        while i < len(names) and names[i].startswith(query):
+            candidates.append(names[i])
+            i += 1
+        if candidates:
+            return places[min(candidates, key=len)]
+
+    matches = difflib.get_close_matches(query, names, n=1, cutoff=GEOCODE_FUZZY_CUTOFF)
+    if matches:
+        return places[matches[0]]
+
+    return None
+
+
+# Treu el municipi del final de la consulta ("carrer d'aragó, barcelona" -> "carrer d'aragó")
+def _strip_city(query):
+
+    parts = [part.strip() for part in query.split(',')]
+    while len(parts) > 1 and parts[-1] in ('barcelona', 'catalunya', 'catalonia', 'espanya', 'españa', 'spain'):
+        parts.pop()
+
+    return ', '.join(parts)
+
+
+# Retorna l'index de noms del graf d'una regio. Es guarda a disc i nomes es torna a construir
+# si canvia el graf o el fitxer de llocs d'interes
+def _get_street_index(system):
+
+    config = _region_config(system['name'])
+
+    with _streets_lock:
 
-        # Guardem la info al diccionari
-        way_id, data_hour, state, next_state = str(line)[2:-2].split('#')
-        congestions[int(way_id)] = Congestion(int(state), int(next_state))
+        key = (system['graph_signature'], _pois_signature(config.poi_filename))
 
-    return congestions
+        # Index en memoria
+        index = system['street_index']
+        if index is not None and index['key'] == key:
+            return index
+
+        # Index guardat a disc
+        index = None
+        if os.path.exists(config.street_index_filename):
+            with open(config.street_index_filename, 'rb') as file:
+                index = pickle.load(file)
+
+        # Cal construir-lo de nou (els noms nomes hi son al graf de networkx)
+        if index is None or index['key'] != key:
+            places = _build_street_index(_get_graph(config.graph_filename, config.place))
+            places.update(_load_pois(config.poi_filename))
+            index = {'key': key, 'places': places}
+            _save_pickle(index, config.street_index_filename)
+
+        # Noms ordenats per buscar per prefix (no es guarden a disc)
+        index['names'] = sorted(index['places'])
+
+        system['street_index'] = index
+        return index
+
+
+# Per cada nom de carrer del graf (i el nom sense el tipus de via), el node del carrer mes proper al seu centre
+def _build_street_index(graph):
+
+    streets = collections.defaultdict(set)
+    for node1, node2, data in graph.edges(data=True):
+        names = data.get('name', [])
+        for name in ([names] if isinstance(names, str) else names):
+            streets[_normalize_query(name)].update((node1, node2))
+
+    places = {}
+    aliases = collections.defaultdict(list)
+    for name, nodes in streets.items():
+        nodes = list(nodes)
+        lats = np.array([graph.nodes[node]['y'] for node in nodes])
+        lons = np.array([graph.nodes[node]['x'] for node in nodes])
+
+        i = int(np.argmin((lats - lats.mean()) ** 2 + (lons - lons.mean()) ** 2))
+        places[name] = (float(lats[i]), float(lons[i]))
+
+        alias = _strip_street_type(name)
+        if alias != name:
+            aliases[alias].append(name)
+
+    # "aragó" es el carrer d'Aragó, sempre que no hi hagi cap altre via amb el mateix nom
+    for alias, names in aliases.items():
+        if alias not in places and len(names) == 1:
+            places[alias] = places[names[0]]
+
+    return places
+
+
+# Treu el tipus de via del principi d'un nom ("carrer d'aragó" -> "aragó")
+def _strip_street_type(name):
+
+    for street_type in STREET_TYPES:
+        if name.startswith(street_type + ' '):
+            rest = name[len(street_type) + 1:]
+            for link in STREET_LINKS:
+                if rest.startswith(link):
+                    return rest[len(link):]
+            return rest
+
+    return name
+
+
+# Llegeix els llocs d'interes del fitxer (si n'hi ha): nom normalitzat -> (lat, lon)
+def _load_pois(filename):
+
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename, 'r', encoding='utf-8') as file:
+        return {_normalize_query(row['name']): (float(row['lat']), float(row['lon'])) for row in csv.DictReader(file)}
+
+
+# Versio del fitxer de llocs d'interes (None si no n'hi ha). Es mira a cada consulta, nomes fa un stat
+def _pois_signature(filename):
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
 
 
 
@@ -165,39 +818,79 @@ def _download_graph(place):
     multigraph = ox.graph_from_place(place, network_type='drive', simplify=True)
     digraph = ox.utils_graph.get_digraph(multigraph, weight='length')
 
+    return _prepare_graph(digraph)
 
-    # Es monta el igraph amb les arestes de graph que tenen 'length' i 'maxspeed'
-    for node1 in digraph.nodes:
 
-        # for each adjacent node and its information...
-        for node2 in digraph.adj[node1]:
+# Afegeix a totes les arestes el temps, la congestio generica i el itime
+# Les dades es treuen en columnes d'una sola passada i els calculs es fan amb numpy
+def _prepare_graph(digraph):
 
-            # Agafem les dades que ens interesen de l'aresta
-            speed = digraph[node1][node2].get('maxspeed', None)
-            length = digraph[node1][node2].get('length', None)
+    edges = [data for _, _, data in digraph.edges(data=True)]
+    length = [data.get('length', math.nan) for data in edges]
+    maxspeed = [data.get('maxspeed', None) for data in edges]
 
+    # Nomes hi ha uns pocs valors de 'maxspeed' diferents, cada un s'interpreta un sol cop
+    speed = np.array([_parse_speed(tuple(value) if type(value) == list else value) for value in maxspeed], dtype=np.float64)
 
-            if type(speed) == list:
-                speed = sum(list(map(float, speed))) / len(speed)
+    # Vigilem amb les vies que no tenen la velocitat assignada (o no es pot interpretar)
+    speed[np.isnan(speed)] = GENERIC_SPEED
 
-            # Vigilem amb les vies que no tenen la velocitat assignada
-            if speed == None:
-                digraph[node1][node2]['maxspeed'] = GENERIC_SPEED
-                speed = GENERIC_SPEED
+    time = np.array(length, dtype=np.float64) / speed
+    itime = _calculate_itimes(time, np.full(len(edges), GENERIC_CONGESTION))
 
+    # Es tornen a escriure els resultats als diccionaris de les arestes
+    for data, speed_value, time_value, itime_value in zip(edges, maxspeed, time.tolist(), itime.tolist()):
+        if speed_value is None:
+            data['maxspeed'] = GENERIC_SPEED
+        data['time'] = time_value
+        data['congestion'] = GENERIC_CONGESTION
+        data['itime'] = itime_value
 
-            time = float(length) / float(speed)
-            digraph[node1][node2]['time'] = time
-            digraph[node1][node2]['congestion'] = GENERIC_CONGESTION
-            digraph[node1][node2]['itime'] = _calculate_itime(time, GENERIC_CONGESTION)
-    
     return digraph
 
 
+# Velocitat (km/h) d'un valor de 'maxspeed' d'OSM: un numero, un text ('50', '30 mph', '50;30') o una tupla de valors
+# Si hi ha mes d'un valor es fa la mitjana. Retorna nan si no es pot interpretar
+@functools.lru_cache(maxsize=None)
+def _parse_speed(value):
+
+    if value is None:
+        return math.nan
+
+    if type(value) == tuple or ';' in str(value):
+        speeds = [speed for speed in map(_parse_speed, value if type(value) == tuple else tuple(str(value).split(';'))) if not math.isnan(speed)]
+        return sum(speeds) / len(speeds) if speeds else math.nan
+
+    text = str(value).strip().lower()
+    factor = 1.609344 if text.endswith('mph') else 1.0
+
+    try:
+        speed = float(text.replace('mph', '').replace('km/h', '').strip()) * factor
+    except ValueError:
+        return math.nan
+
+    return speed if speed > 0 else math.nan
+
+
 # Guarda el graph en el pickle
 def _save_graph(graph, filename):
-    with open(filename, 'wb') as file:
-        pickle.dump(graph, file)
+    _save_pickle(graph, filename)
+
+
+# Guarda un valor en un pickle compartit entre processos: s'escriu en un fitxer temporal propi
+# i es canvia de nom al final, aixi qui el llegeix el troba sencer (el vell o el nou)
+def _save_pickle(value, filename):
+
+    tmp_filename = _tmp_filename(filename)
+    with open(tmp_filename, 'wb') as file:
+        pickle.dump(value, file)
+    os.replace(tmp_filename, filename)
+
+
+# Nom temporal d'un fitxer, diferent per cada proces i fil
+def _tmp_filename(filename):
+
+    return '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
 
 
 # Agafa el graf que ja tenim guardat al pickle
@@ -207,10 +900,10 @@ def _load_graph(filename):
 
 
 # Carrega / Descarrega el graf i el guarda en un PNG
-def _get_graph(filename):
+def _get_graph(filename, place=None):
 
     if not _exists_graph(filename):
-        graph = _download_graph(PLACE)
+        graph = _download_graph(place or PLACE)
         _save_graph(graph, filename)
     else:
         graph = _load_graph(filename)
@@ -218,176 +911,1873 @@ def _get_graph(filename):
     return graph
 
 
+# Retorna el graf d'una regio en format binari i el seu identificador
+# Si nomes tenim el pickle (o res) es converteix, aixi les instal·lacions existents migren soles
+def _get_binary_graph(region):
 
+    if not os.path.exists(os.path.join(region.binary_graph_dirname, 'meta.json')):
+        _convert_graph(region.graph_filename, region.binary_graph_dirname, region.place)
 
-#################################################
-##### Funcions Privades per Generar Imatges #####
-#################################################
+    return _load_binary_graph(region.binary_graph_dirname)
 
 
-# Genera una imatge amb un Marker en la posicio indicada
-def _plot_position(lon, lat, size, image_name):
+# Converteix el graf guardat al pickle (o el descarrega) al format binari
+def _convert_graph(filename, dirname, place=None):
 
-    # Creem el mapa
-    m_bcn = sm.StaticMap(size, size)
+    _save_binary_graph(_build_csr(_get_graph(filename, place)), dirname)
 
-    # Posem el marcador en la possicio indicada
-    marker = sm.CircleMarker((lon, lat), 'red', 50)
-    m_bcn.add_marker(marker)
 
-    # Guardem la imatge
-    image = m_bcn.render()
-    image.save(image_name)
+# Guarda un CSR en format binari: un fitxer .npy per array i un meta.json
+# S'escriu en un directori temporal propi i es canvia de nom al final, perque un altre proces no en llegeixi un de mig escrit
+# Si un altre proces l'ha convertit alhora i ja l'ha canviat de nom, es fa servir el seu
+def _save_binary_graph(csr, dirname):
 
+    tmp_dirname = _tmp_filename(dirname)
+    os.makedirs(tmp_dirname, exist_ok=True)
 
-# Genera una imatge amb un path marcat
-def _plot_path(graph, path, size, image_name, use_colors):
+    signature = hashlib.sha1()
+    for field in BINARY_GRAPH_FIELDS:
+        array = np.ascontiguousarray(getattr(csr, field))
+        np.save(os.path.join(tmp_dirname, field + '.npy'), array)
+        signature.update(array.tobytes())
 
-    # Creem el mapa
-    m_bcn = sm.StaticMap(size, size)
+    with open(os.path.join(tmp_dirname, 'meta.json'), 'w') as file:
+        json.dump({'signature': signature.hexdigest(), 'nodes': len(csr.nodes), 'edges': len(csr.targets)}, file)
 
-    first = True
+    try:
+        os.replace(tmp_dirname, dirname)
+    except OSError:
+        if not os.path.exists(os.path.join(dirname, 'meta.json')):
+            raise
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
 
-    #Per cada segment
-    for node in path:
 
-        # Afegim un marker en el punt inicial
-        if first:
-            lon = graph.nodes[node]['x']
-            lat = graph.nodes[node]['y']
-            start_marker = sm.CircleMarker((lon, lat), 'red', 12)
-            m_bcn.add_marker(start_marker)
+# Carrega un CSR guardat en format binari. Els arrays es mapegen a memoria (nomes lectura),
+# aixi la carrega es immediata i els processos que fan servir el mateix fitxer comparteixen les pagines
+def _load_binary_graph(dirname):
 
-            first = False
+    with open(os.path.join(dirname, 'meta.json')) as file:
+        meta = json.load(file)
 
+    # np.asarray dona un ndarray normal (mes rapid d'indexar que np.memmap) sobre les mateixes pagines
+    arrays = {field: np.asarray(np.load(os.path.join(dirname, field + '.npy'), mmap_mode='r')) for field in BINARY_GRAPH_FIELDS}
+    index = {node: i for i, node in enumerate(arrays['nodes'].tolist())}
 
-        # Pintem cada aresta de la ruta
-        else:
+    return CSR(index=index, **arrays), meta['signature']
 
-            lon0 = graph.nodes[ant]['x']
-            lat0 = graph.nodes[ant]['y']
-            lon1 = graph.nodes[node]['x']
-            lat1 = graph.nodes[node]['y']
 
-            if not use_colors: color = 'red'
-            elif graph[ant][node]['congestion'] in GREEN_STREETS: color = 'green'
-            elif graph[ant][node]['congestion'] in ORANGE_STREETS: color = 'orange'
-            else: color = 'red'
+# Retorna el igraph resident en memoria d'una regio (per defecte DEFAULT_REGION)
+def _get_igraph(region=None):
 
-            m_bcn.add_line(sm.Line(((float(lon0), float(lat0)), (float(lon1), float(lat1))), color, 4)) #Pintem la linia
+    system = _load_system(region or DEFAULT_REGION)
 
-        ant = node
+    with system['lock']:
+        return system['igraph']
 
 
-    # Possem una bandereta en el punt final
-    lon = graph.nodes[path[-1]]['x']
-    lat = graph.nodes[path[-1]]['y']
-    finish_marker = sm.CircleMarker((lon, lat), 'red', 12)
-    m_bcn.add_marker(finish_marker)
+# Publica uns nous pesos d'una regio, les peticions en curs continuen amb la versio anterior
+# Retorna el igraph publicat
+def _set_igraph(system, weights):
 
-    image = m_bcn.render()
-    image.save(image_name)
+    # Les dades derivades es calculen fora del lock per no aturar les consultes
+    igraph = _make_igraph(system, weights, 0)
 
+    with system['lock']:
+        system['version'] += 1
+        igraph = igraph._replace(version=system['version'])
+        system['igraph'] = igraph
 
+    _set_gauge('graph_version', igraph.version, region=system['name'])
+    return igraph
 
 
-###########################################################
-##### Funcions Privades per Calcular el cami mes Curt #####
-###########################################################
+# Crea el IGraph d'uns pesos amb les dades derivades que necessiten les consultes
+# La jerarquia de contraccio nomes es personalitza si es l'algorisme per defecte
+# El igraph porta l'estat de la regio: les caches (arbre KD, jerarquia...) es continuen trobant encara que la regio es descarregui
+def _make_igraph(system, weights, version):
 
+    csr = system['csr']
+    cch = _get_cch_metric(system, weights) if ROUTING_MODE == 'cch' else None
 
-# Retorna la versió "inteligent" del graf de la ciutat.
-def _build_igraph(graph, highways, congestions):
+    return IGraph(csr, weights, _build_matrix(csr, weights.itime), _min_cost(csr, weights), cch, version, system)
 
-    # Per cada via de la que tenim info de la congestio
-    for key in congestions:
 
-        # Si tenim els segments de la via
-        if key in highways.keys():
+# Bucle del fil de refresc d'una regio: el primer refresc es fa de seguida
+# Aprofita per descarregar les regions que ja no es fan servir
+def _refresher_loop(system, period):
 
-            # Coordenades dels segments
-            lon_list = highways[key].coordinates[::2]   # Llista de longituds
-            lat_list = highways[key].coordinates[1::2]  # Llista de latituds
+    while not system['stop_refresher'].is_set():
 
-            # Nodes mes propers als extrems dels segments
-            nodes_list = ox.distance.nearest_nodes(graph, lon_list, lat_list)
+        # Si falla la descarrega continuem amb el igraph anterior fins al seguent intent
+        try:
+            _refresh_system(system)
+        except Exception as error:
+            print('No s\'ha pogut refrescar la congestio de %s:' % system['name'], error)
 
-            # Els separem en nodes d'origen i de desti:
-            org_node_list = nodes_list[0:-1]
-            dest_node_list = nodes_list[1:]
+        with _regions_lock:
+            shared = _refreshers['shared']
 
-            # Propaguem la congestio del highway a tots els segments
-            congestion = congestions[key].state
-            _congestion_propagation(graph, org_node_list, dest_node_list, congestion)
+        if shared:
+            _load_wanted_regions()
 
+        _evict_regions()
+        system['stop_refresher'].wait(period)
 
-# Retorna el cami "inteligent" entre dos adresses
-def _get_shortest_ipath(graph, org, dest):
-    try:
-        return ox.distance.shortest_path(graph, org, dest, weight = 'itime')
-    except:
-        return None
 
+# Bucle del fil que segueix els pesos que publica el proces que refresca (veure follow_refresher)
+def _follower_loop(system, period):
 
-# Propaga la congestio d'un tram al graph d'OSMnx
-def _congestion_propagation(graph, org_nodes, dest_nodes, congestion):
+    while not system['stop_refresher'].is_set():
 
-    # Busquem el cami mes curt entre node1 i node2
-    # list_of_paths = ox.distance.shortest_path(graph, org_nodes, dest_nodes)
+        # Si no es poden llegir continuem amb el igraph anterior fins al seguent intent
+        try:
+            _follow_system(system)
+        except Exception as error:
+            print('No s\'han pogut llegir els pesos publicats de %s:' % system['name'], error)
 
-    list_of_paths = []
-    for i in range(len(org_nodes)):
+        _evict_regions()
+        system['stop_refresher'].wait(period)
 
-        try:
-            path = ox.distance.shortest_path(graph, org_nodes[i], dest_nodes[i])
-            list_of_paths.append(path)
-        except:
-            pass
 
-    # Iterem per tots els paths generats
-    for path in list_of_paths:
 
-        #Iterem per cada node
-        first = True
-        for node2 in path:
 
-            if first:
-                first = False
+###################################################
+##### Funcions Privades per Gestionar Regions #####
+###################################################
 
-            else:
-                # Mirem que no haguem eliminat l'aresta en una iteracio anterior
-                if node2 in graph.adj[node1]:
 
-                    # itime en funcio de la congestio
-                    graph[node1][node2]['congestion'] = congestion
-                    itime = _calculate_itime(graph[node1][node2]['time'], congestion)
-                    
-                    # Mirem si hem d'esborrar l'aresta o no
-                    if itime == -1: graph.remove_edge(node1, node2)
-                    else: graph[node1][node2]['itime'] = itime
+# Retorna l'estat d'una regio i, si no ho esta, en carrega el graf
+# Si es carrega, engega el seu refresc (si els refrescos estan engegats) i es descarreguen les regions que sobren
+def _load_system(name):
 
-            node1 = node2
+    config = _region_config(name)
 
+    with _regions_lock:
+        system = _regions.get(name)
+        if system is None:
+            system = _new_system(name)
+            _regions[name] = system
 
-# Calcula el itime a partir de un temps i una congestio
-def _calculate_itime(time, congestion):
+    system['last_used'] = time.time()
 
-    # Via tallada
-    if congestion == 6:
-        return -1
+    loaded = False
+    with system['lock']:
+        if system['csr'] is None:
 
-    # Via sense informacio
-    if congestion == 0:
-        congestion = GENERIC_CONGESTION
+            # Descarreguem / Carreguem el graf (en format binari, el graf de networkx no es carrega)
+            with span('graph_load', region=name):
+                csr, signature = _get_binary_graph(config)
 
-    return time * math.sqrt(congestion)
+            # Fins al primer refresc el igraph es el graf base (congestio generica)
+            system['graph_signature'] = signature
+            system['csr'] = csr
+            system['bbox'] = (float(np.min(csr.x)), float(np.min(csr.y)), float(np.max(csr.x)), float(np.max(csr.y)))
+            system['version'] = 1
+            system['igraph'] = _make_igraph(system, _base_weights(csr), 1)
+            loaded = True
 
+    if loaded:
+        _start_system_refresher(system)
+        _evict_regions(keep=system)
 
+    return system
 
 
-#########################################
-##### Funcions Auxiliars de Testeig #####
-#########################################
+# Configuracio d'una regio (veure register_region)
+def _make_region(name, place, highways_url=None, congestions_url=None, refresh_period=None, bbox=None):
+
+    return Region(
+        place=place,
+        graph_filename=name + '.graph',
+        binary_graph_dirname=name + '_graph',
+        weights_dirname=name + '_weights',
+        tram_index_filename=name + '_trams.index',
+        cch_filename=name + '.cch',
+        street_index_filename=name + '_streets.index',
+        poi_filename=name + '_pois.csv',
+        highways_url=highways_url,
+        congestions_url=congestions_url,
+        refresh_period=refresh_period,
+        bbox=None if bbox is None else tuple(bbox))
+
+
+# Estat buit d'una regio
+def _new_system(name):
+
+    return dict({key: None for key in _system}, name=name, lock=threading.Lock(), refresh_lock=threading.Lock(), cch_lock=threading.Lock(), stop_refresher=threading.Event(), version=0, edges_touched=0, last_used=time.time())
+
+
+# Fitxers i dades d'una regio. Els de la regio per defecte son les constants del modul
+def _region_config(name):
+
+    if name == DEFAULT_REGION and name not in _region_configs['regions']:
+        return Region(PLACE, GRAPH_FILENAME, BINARY_GRAPH_DIRNAME, WEIGHTS_DIRNAME, TRAM_INDEX_FILENAME, CCH_FILENAME, STREET_INDEX_FILENAME, POI_FILENAME, HIGHWAYS_URL, CONGESTIONS_URL, None, None)
+
+    _load_region_file()
+
+    if name not in _region_configs['regions']:
+        raise ValueError('Regio desconeguda: %s' % name)
+
+    return _region_configs['regions'][name]
+
+
+# Registra les regions de REGIONS_FILENAME (si n'hi ha) el primer cop que es consulten les regions
+# Les que ja s'han registrat amb register_region tenen preferencia
+def _load_region_file():
+
+    with _regions_lock:
+        if _region_configs['loaded']:
+            return
+
+        if os.path.exists(REGIONS_FILENAME):
+            with open(REGIONS_FILENAME, 'r', encoding='utf-8') as file:
+                for region in json.load(file):
+                    _region_configs['regions'].setdefault(region['name'], _make_region(**region))
+
+        _region_configs['loaded'] = True
+
+
+# Nom de la regio que conte el punt (lon, lat): la mes petita de les que el contenen, o DEFAULT_REGION
+# Les regions carregades fan servir l'extensio del seu graf, les altres la "bbox" amb que s'han registrat
+def _region_at(lon, lat):
+
+    _load_region_file()
+    configs = {name: _region_config(name) for name in set(_region_configs['regions']) | {DEFAULT_REGION}}
+
+    candidates = []
+    with _regions_lock:
+        for name, config in configs.items():
+            system = _regions.get(name)
+            bbox = system['bbox'] if system is not None and system['bbox'] is not None else config.bbox
+
+            if bbox is not None and bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]:
+                candidates.append(((bbox[2] - bbox[0]) * (bbox[3] - bbox[1]), name))
+
+    return min(candidates)[1] if candidates else DEFAULT_REGION
+
+
+# Descarrega les regions que fa mes de REGION_IDLE_TIME que no es fan servir i, mentre els grafs
+# carregats ocupin mes de REGION_MEMORY_BUDGET, les menys usades. La regio per defecte i "keep" es queden
+# Les peticions en curs d'una regio descarregada acaben amb el igraph que ja tenien
+def _evict_regions(keep=None):
+
+    now = time.time()
+    evicted = []
+
+    with _regions_lock:
+        loaded = [system for system in _regions.values() if system['csr'] is not None]
+
+    # Les mides es calculen fora del bloqueig, que recorrer les caches d'una regio gran es lent
+    sizes = {id(system): _system_bytes(system) for system in loaded}
+    total = sum(sizes.values())
+
+    with _regions_lock:
+        for system in sorted(loaded, key=lambda system: system['last_used']):
+            if system is _system or system is keep or _regions.get(system['name']) is not system:
+                continue
+
+            if now - system['last_used'] > REGION_IDLE_TIME or total > REGION_MEMORY_BUDGET:
+                total -= sizes[id(system)]
+                del _regions[system['name']]
+                evicted.append(system)
+
+    for system in evicted:
+        _stop_system_refresher(system)
+        count('region_evictions', region=system['name'])
+
+
+# Bytes (aproximats) que ocupa una regio carregada: el graf, els pesos publicats i totes les caches
+# (arbre KD, jerarquia, adjacencies en llistes, index de nodes, indexs de trams i carrers)
+def _system_bytes(system):
+
+    return _value_bytes([system[key] for key in ('csr', 'igraph', 'tree', 'cch', 'cch_metric', 'reverse', 'forecast', 'tram_index', 'street_index', 'highways')], {id(system)})
+
+
+# Bytes (aproximats) d'un valor amb el que conte. "seen" son els objectes ja comptats
+# Les llistes d'escalars es compten pel primer element, per no recorrer-les senceres
+def _value_bytes(value, seen):
+
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+
+    if isinstance(value, scipy.sparse.spmatrix):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+
+    if isinstance(value, scipy.spatial.cKDTree):
+        # Els punts, la permutacio i els nodes de l'arbre (de l'ordre dels punts)
+        return 2 * value.data.nbytes + value.indices.nbytes
+
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_value_bytes(key, seen) + _value_bytes(item, seen) for key, item in value.items())
+
+    if isinstance(value, (list, tuple, set)):
+        size = sys.getsizeof(value)
+        if value and isinstance(next(iter(value)), (int, float, np.generic)):
+            return size + len(value) * sys.getsizeof(next(iter(value)))
+        return size + sum(_value_bytes(item, seen) for item in value)
+
+    return sys.getsizeof(value)
+
+
+# Engega el fil de refresc de cada regio carregada (i la per defecte)
+def _start_refreshers():
+
+    _load_system(DEFAULT_REGION)
+
+    with _regions_lock:
+        systems = list(_regions.values())
+
+    for system in systems:
+        if system['csr'] is not None:
+            _start_system_refresher(system)
+
+
+# Engega el fil de refresc d'una regio, si els refrescos estan engegats i la regio te dades de congestio
+# Si se segueix el refresc d'un altre proces, el fil nomes mira si hi ha pesos nous
+def _start_system_refresher(system):
+
+    config = _region_config(system['name'])
+
+    with _regions_lock:
+        period, follow = _refreshers['period'], _refreshers['follow']
+
+    if period is None or config.highways_url is None or config.congestions_url is None:
+        return
+
+    if follow:
+        target, name = _follower_loop, 'igo-follower-'
+    else:
+        target, name, period = _refresher_loop, 'igo-refresher-', config.refresh_period or period
+
+    with system['lock']:
+        if system['refresher'] is not None:
+            return
+
+        system['stop_refresher'].clear()
+        thread = threading.Thread(target=target, args=(system, period), name=name + system['name'], daemon=True)
+        system['refresher'] = thread
+
+    thread.start()
+
+
+# Atura el fil de refresc d'una regio
+def _stop_system_refresher(system):
+
+    with system['lock']:
+        thread = system['refresher']
+        system['refresher'] = None
+
+    if thread is not None:
+        system['stop_refresher'].set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+
+# Refresca la congestio d'una regio (veure refresh_igraph)
+def _refresh_system(system):
+
+    config = _region_config(system['name'])
+
+    # Les regions sense dades de congestio es queden amb la congestio generica
+    if config.highways_url is None or config.congestions_url is None:
+        return 0
+
+    with system['refresh_lock'], span('refresh', region=system['name']):
+
+        # Nomes es descarrega el que ha canviat, i els trams nomes es tornen a llegir si ha canviat el fitxer
+        highways = _get_cached_highways(system, _fetch_feed(config.highways_url))
+        data_hour, congestions = _get_congestions(_fetch_feed(config.congestions_url))
+        index = _get_tram_index(system, highways)
+
+        # Si les dades no son mes noves que les que ja s'han aplicat no cal fer res
+        applied = system['applied']
+        if applied is not None and applied['key'] == index['key'] and data_hour <= applied['data_hour']:
+            system['edges_touched'] = 0
+            count('refreshes', region=system['name'], result='unchanged')
+            return 0
+
+        # Nomes actualitzem les arestes dels trams que han canviat des del darrer refresc
+        # Si ha canviat l'index es torna a partir del graf base
+        if applied is None or applied['key'] != index['key']:
+            applied = {'key': index['key'], 'congestions': {}}
+            weights = _base_weights(system['csr'])
+
+        # Els pesos publicats no es toquen, es copien els arrays (el graf no es copia mai)
+        else:
+            current = system['igraph'].weights
+            weights = Weights(current.congestion.copy(), current.itime.copy(), current.next_itime.copy())
+
+        with span('update_weights', region=system['name']):
+            touched = _update_igraph(system['csr'], weights, index, applied['congestions'], congestions)
+
+        # Si no ha canviat cap aresta es mante la versio publicada (i les imatges ja pintades)
+        if touched or applied is not system['applied']:
+            igraph = _set_igraph(system, weights)
+
+            with _regions_lock:
+                shared = _refreshers['shared']
+
+            if shared:
+                _save_shared_weights(system, igraph)
+
+        system['applied'] = {'key': index['key'], 'data_hour': data_hour, 'congestions': congestions}
+        system['edges_touched'] = touched
+
+        count('refreshes', region=system['name'], result='updated')
+        count('edges_touched', touched, region=system['name'])
+        return touched
+
+
+# Guarda a disc els pesos d'un igraph publicat, pels processos que segueixen el refresc (un .npy per array, com el graf)
+# Cada versio va a un directori propi i "current.json" diu quina es la darrera. Es conserva la versio anterior,
+# que algun proces pot estar mapejant just ara, i les mes velles s'esborren
+def _save_shared_weights(system, igraph):
+
+    dirname = _region_config(system['name']).weights_dirname
+    name = '%d.%d' % (os.getpid(), igraph.version)
+
+    tmp_dirname = _tmp_filename(os.path.join(dirname, name))
+    os.makedirs(tmp_dirname)
+    for field in Weights._fields:
+        np.save(os.path.join(tmp_dirname, field + '.npy'), getattr(igraph.weights, field))
+    os.replace(tmp_dirname, os.path.join(dirname, name))
+
+    previous = _shared_weights_version(dirname)
+    current_filename = os.path.join(dirname, 'current.json')
+    tmp_filename = _tmp_filename(current_filename)
+    with open(tmp_filename, 'w') as file:
+        json.dump({'name': name, 'signature': system['graph_signature']}, file)
+    os.replace(tmp_filename, current_filename)
+
+    keep = {name, 'current.json', 'wanted', previous['name'] if previous is not None else None}
+    for entry in os.listdir(dirname):
+        if entry not in keep:
+            shutil.rmtree(os.path.join(dirname, entry), ignore_errors=True)
+
+
+# Darrera versio dels pesos publicats d'una regio ({name, signature}), None si encara no n'hi ha
+def _shared_weights_version(dirname):
+
+    try:
+        with open(os.path.join(dirname, 'current.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+# Mapeja (nomes lectura) i publica la darrera versio dels pesos publicats d'una regio, si es nova i es del mateix graf
+# Tambe marca la regio com a "volguda" perque el proces que refresca la carregui. Retorna si hi havia pesos nous
+def _follow_system(system):
+
+    dirname = _region_config(system['name']).weights_dirname
+    os.makedirs(dirname, exist_ok=True)
+    with open(os.path.join(dirname, 'wanted'), 'a'):
+        os.utime(os.path.join(dirname, 'wanted'))
+
+    current = _shared_weights_version(dirname)
+    if current is None or current['signature'] != system['graph_signature'] or current['name'] == system['shared']:
+        return False
+
+    arrays = {field: np.asarray(np.load(os.path.join(dirname, current['name'], field + '.npy'), mmap_mode='r')) for field in Weights._fields}
+    _set_igraph(system, Weights(**arrays))
+    system['shared'] = current['name']
+    return True
+
+
+# Carrega (i per tant refresca) les regions que algun proces que segueix el refresc ha fet servir fa menys de REGION_IDLE_TIME
+def _load_wanted_regions():
+
+    _load_region_file()
+    now = time.time()
+
+    for name in set(_region_configs['regions']) | {DEFAULT_REGION}:
+        try:
+            wanted = os.path.getmtime(os.path.join(_region_config(name).weights_dirname, 'wanted'))
+        except OSError:
+            continue
+
+        if now - wanted < REGION_IDLE_TIME:
+            _load_system(name)
+
+
+
+
+
+#################################################
+##### Funcions Privades per Generar Imatges #####
+#################################################
+
+
+# Genera una imatge amb un Marker en la posicio indicada
+def _plot_position(lon, lat, size):
+
+    # Creem el mapa
+    m_bcn = _new_map(size, size)
+
+    # Posem el marcador en la possicio indicada
+    marker = sm.CircleMarker((lon, lat), 'red', 50)
+    m_bcn.add_marker(marker)
+
+    return m_bcn.render()
+
+
+# Retorna la imatge (en bytes, codificada amb el format i la compressio indicats) d'un path marcat
+# "path" es una llista de posicions de nodes del CSR
+# Es guarda codificada: ocupa molt menys que la imatge i els encerts no la tornen a codificar
+def _plot_path(igraph, path, size, use_colors, image_format=None, compress_level=None):
+
+    # Sense colors la imatge no depen de la congestio
+    key = (igraph.system['name'], tuple(path), size, use_colors, igraph.version if use_colors else None, (image_format or IMAGE_FORMAT).upper(), compress_level)
+
+    with _renders_lock:
+        image = _renders.get(key)
+        if image is not None:
+            _renders.move_to_end(key)
+
+    count('render_cache', result='hit' if image is not None else 'miss')
+
+    if image is None:
+        image = _render_path(igraph, path, size, use_colors)
+
+        with span('encode'):
+            image = _encode_image(image, image_format, compress_level).getvalue()
+
+        with _renders_lock:
+            _renders[key] = image
+            while len(_renders) > RENDER_CACHE_SIZE:
+                _renders.popitem(last=False)
+
+    return image
+
+
+# Pinta la imatge d'un path
+def _render_path(igraph, path, size, use_colors):
+
+    csr = igraph.csr
+
+    # Creem el mapa
+    m_bcn = _new_map(size, size)
+
+    first = True
+
+    #Per cada segment
+    for node in path:
+
+        # Afegim un marker en el punt inicial
+        if first:
+            lon = csr.x[node]
+            lat = csr.y[node]
+            start_marker = sm.CircleMarker((float(lon), float(lat)), 'red', 12)
+            m_bcn.add_marker(start_marker)
+
+            first = False
+
+
+        # Pintem cada aresta de la ruta
+        else:
+
+            lon0 = csr.x[ant]
+            lat0 = csr.y[ant]
+            lon1 = csr.x[node]
+            lat1 = csr.y[node]
+
+            congestion = igraph.weights.congestion[_csr_edge(csr, ant, node)]
+
+            if not use_colors: color = 'red'
+            elif congestion in GREEN_STREETS: color = 'green'
+            elif congestion in ORANGE_STREETS: color = 'orange'
+            else: color = 'red'
+
+            m_bcn.add_line(sm.Line(((float(lon0), float(lat0)), (float(lon1), float(lat1))), color, 4)) #Pintem la linia
+
+        ant = node
+
+
+    # Possem una bandereta en el punt final
+    lon = csr.x[path[-1]]
+    lat = csr.y[path[-1]]
+    finish_marker = sm.CircleMarker((float(lon), float(lat)), 'red', 12)
+    m_bcn.add_marker(finish_marker)
+
+    return m_bcn.render()
+
+
+# Codifica una imatge en memoria amb el format i la compressio indicats
+def _encode_image(image, image_format=None, compress_level=None):
+
+    image_format = (image_format or IMAGE_FORMAT).upper()
+    buffer = io.BytesIO()
+
+    if image_format == 'PNG':
+        image.save(buffer, format='PNG', compress_level=IMAGE_COMPRESS_LEVEL if compress_level is None else compress_level)
+
+    # JPEG no te transparencia; aqui "compress_level" es la qualitat
+    elif image_format == 'JPEG':
+        image.convert('RGB').save(buffer, format='JPEG', quality=IMAGE_QUALITY if compress_level is None else compress_level)
+
+    else:
+        image.save(buffer, format=image_format)
+
+    buffer.seek(0)
+    return buffer
+
+
+# Crea un mapa que obte les tessel·les a traves de la cache de disc
+def _new_map(width, height):
+
+    return _CachedStaticMap(width, height, url_template=TILE_URL_TEMPLATE)
+
+
+# Mapa de staticmap que llegeix les tessel·les d'un directori local o de la cache abans de descarregar-les
+class _CachedStaticMap(sm.StaticMap):
+
+    # Retorna el codi d'estat i el contingut d'una tessel·la
+    def get(self, url, **kwargs):
+
+        # Directori local de tessel·les (per exemple per treballar sense xarxa)
+        if '://' not in url:
+            if not os.path.exists(url):
+                return 404, None
+            with open(url, 'rb') as file:
+                return 200, file.read()
+
+        content = _get_cached_tile(url)
+        count('tile_cache', result='hit' if content is not None else 'miss')
+        if content is not None:
+            return 200, content
+
+        with span('tile_download'):
+            status, content = super().get(url, **kwargs)
+        if status == 200:
+            _put_cached_tile(url, content)
+
+        return status, content
+
+
+# Retorna el contingut d'una tessel·la de la cache, None si no hi es
+def _get_cached_tile(url):
+
+    filename = _tile_filename(url)
+
+    with _tiles_lock:
+        files = _tile_files()
+        if filename not in files:
+            return None
+        files.move_to_end(filename)
+
+    try:
+        with open(filename, 'rb') as file:
+            content = file.read()
+        os.utime(filename) # L'ordre LRU es manté entre reinicis
+        return content
+    except OSError:
+        return None
+
+
+# Guarda una tessel·la a la cache i n'esborra les menys usades si se supera TILE_CACHE_SIZE
+def _put_cached_tile(url, content):
+
+    filename = _tile_filename(url)
+    tmp_filename = _tmp_filename(filename)
+
+    with open(tmp_filename, 'wb') as file:
+        file.write(content)
+    os.replace(tmp_filename, filename)
+
+    with _tiles_lock:
+        files = _tile_files()
+        _tiles['size'] += len(content) - files.pop(filename, 0)
+        files[filename] = len(content)
+
+        while _tiles['size'] > TILE_CACHE_SIZE and len(files) > 1:
+            old_filename, old_size = files.popitem(last=False)
+            _tiles['size'] -= old_size
+            try:
+                os.remove(old_filename)
+            except OSError:
+                pass
+
+
+# Fitxers de la cache en ordre d'us (del menys al mes recent). Cal tenir _tiles_lock
+def _tile_files():
+
+    if _tiles['files'] is None:
+        os.makedirs(TILE_CACHE_DIRNAME, exist_ok=True)
+
+        entries = []
+        for name in os.listdir(TILE_CACHE_DIRNAME):
+            if name.endswith('.tmp'): continue
+            stat = os.stat(os.path.join(TILE_CACHE_DIRNAME, name))
+            entries.append((stat.st_mtime, os.path.join(TILE_CACHE_DIRNAME, name), stat.st_size))
+
+        _tiles['files'] = collections.OrderedDict((filename, size) for _, filename, size in sorted(entries))
+        _tiles['size'] = sum(size for _, _, size in entries)
+
+    return _tiles['files']
+
+
+# Nom del fitxer de la cache d'una tessel·la
+def _tile_filename(url):
+
+    return os.path.join(TILE_CACHE_DIRNAME, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+
+
+##################################################
+##### Funcions Privades per l'Index de Trams #####
+##################################################
+
+
+# Retorna l'index de trams per al graf base i els highways indicats
+# L'index nomes es recalcula quan canvia el graf o la geometria dels trams
+def _get_tram_index(system, highways):
+
+    config = _region_config(system['name'])
+    key = (system['graph_signature'], _highways_signature(highways))
+
+    # Index en memoria
+    index = system['tram_index']
+    if index is not None and index['key'] == key:
+        return index
+
+    # Index guardat a disc
+    index = None
+    if os.path.exists(config.tram_index_filename):
+        with open(config.tram_index_filename, 'rb') as file:
+            index = pickle.load(file)
+
+    # Cal construir-lo de nou
+    if index is None or index['key'] != key:
+        index = {'key': key, 'edges': _build_tram_index(system, highways)}
+        _save_pickle(index, config.tram_index_filename)
+
+    # Arestes com a posicions del CSR i index invers (no es guarden a disc)
+    csr = system['csr']
+    index['eids'] = {key: [_csr_edge(csr, csr.index[node1], csr.index[node2]) for node1, node2 in edges] for key, edges in index['edges'].items()}
+    index['trams'] = _build_edge_trams(index['eids'])
+
+    system['tram_index'] = index
+    return index
+
+
+# Construeix l'index de trams: per cada way_id, la llista d'arestes (node1, node2) que cobreix
+# Les arestes es guarden amb els identificadors d'OSM perque l'index no depengui del CSR
+def _build_tram_index(system, highways):
+
+    csr = system['csr']
+    index = {}
+    matrix = _build_matrix(csr, csr.length)
+
+    # Nodes mes propers als extrems dels segments de tots els trams alhora
+    keys = list(highways)
+    lon_list = [lon for key in keys for lon in highways[key].coordinates[::2]]
+    lat_list = [lat for key in keys for lat in highways[key].coordinates[1::2]]
+    all_nodes = _nearest_nodes(system, lon_list, lat_list)
+
+    start = 0
+    for key in keys:
+
+        nodes_list = all_nodes[start:start + len(highways[key].coordinates) // 2]
+        start += len(nodes_list)
+
+        # Cami mes curt (per longitud) entre cada parell de nodes consecutius
+        edges = []
+        for org, dest in zip(nodes_list[0:-1], nodes_list[1:]):
+
+            path = _csr_dijkstra(matrix, org, dest)
+
+            if path is not None:
+                edges.extend((int(csr.nodes[i]), int(csr.nodes[j])) for i, j in zip(path[0:-1], path[1:]))
+
+        index[key] = edges
+
+    return index
+
+
+# Retorna per cada aresta la llista de trams que la cobreixen, en l'ordre de l'index
+def _build_edge_trams(edges):
+
+    trams = {}
+    for key in edges:
+        for edge in edges[key]:
+            trams.setdefault(edge, []).append(key)
+
+    return trams
+
+
+# Identificador de la geometria dels trams
+def _highways_signature(highways):
+
+    return hashlib.sha1(repr(sorted(highways.items())).encode('utf-8')).hexdigest()
+
+
+
+
+########################################################
+##### Funcions Privades per al Graf Compacte (CSR) #####
+########################################################
+
+
+# Converteix el graf de networkx a una representacio compacta (Compressed Sparse Row)
+# Els nodes es numeren de 0 a n-1 i les arestes que surten del node i son les
+# posicions offsets[i]..offsets[i+1] dels arrays d'arestes, ordenades per desti
+def _build_csr(graph):
+
+    nodes = sorted(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    targets, length, time, itime, congestion = [], [], [], [], []
+
+    for i, node1 in enumerate(nodes):
+
+        for node2 in sorted(graph.adj[node1], key=index.get):
+            data = graph[node1][node2]
+            targets.append(index[node2])
+            length.append(data['length'])
+            time.append(data['time'])
+            itime.append(data['itime'])
+            congestion.append(data['congestion'])
+
+        offsets[i + 1] = len(targets)
+
+    return CSR(
+        nodes=np.array(nodes, dtype=np.int64),
+        index=index,
+        x=np.array([graph.nodes[node]['x'] for node in nodes], dtype=np.float64),
+        y=np.array([graph.nodes[node]['y'] for node in nodes], dtype=np.float64),
+        offsets=offsets,
+        targets=np.array(targets, dtype=np.int32),
+        length=np.array(length, dtype=np.float64),
+        time=np.array(time, dtype=np.float64),
+        itime=np.array(itime, dtype=np.float64),
+        congestion=np.array(congestion, dtype=np.int8))
+
+
+# Retorna les posicions del CSR dels nodes mes propers a cada punt (llistes de longituds i latituds) d'una regio
+# L'arbre KD es construeix un sol cop per regio i es fa servir per totes les consultes
+def _nearest_nodes(system, lons, lats):
+
+    csr = system['csr']
+    tree = system['tree']
+    if tree is None:
+        tree = scipy.spatial.cKDTree(_project(csr, csr.x, csr.y))
+        system['tree'] = tree
+
+    _, nodes = tree.query(_project(csr, np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)))
+    return nodes.tolist()
+
+
+# Projecta coordenades a metres (equirectangular centrada al graf), prou precis dins d'una ciutat
+def _project(csr, lons, lats):
+
+    lat0 = math.radians(float(np.mean(csr.y)))
+    radius = 6371009.0
+    return np.column_stack((np.radians(lons) * math.cos(lat0) * radius, np.radians(lats) * radius))
+
+
+# Pesos inicials (congestio generica) d'un CSR
+def _base_weights(csr):
+
+    return Weights(csr.congestion.copy(), csr.itime.copy(), csr.itime.copy())
+
+
+# Retorna la posicio de l'aresta (node1, node2) dins del CSR, None si no existeix
+def _csr_edge(csr, node1, node2):
+
+    start, end = csr.offsets[node1], csr.offsets[node1 + 1]
+    k = start + np.searchsorted(csr.targets[start:end], node2)
+
+    if k < end and csr.targets[k] == node2:
+        return int(k)
+
+    return None
+
+
+# Matriu dispersa de scipy amb el pes indicat. Les arestes amb pes infinit no es poden fer servir
+def _build_matrix(csr, weight):
+
+    n = len(csr.nodes)
+    return scipy.sparse.csr_matrix((weight, csr.targets, csr.offsets), shape=(n, n))
+
+
+# Dijkstra sobre el CSR. Retorna la llista de posicions dels nodes del cami, None si no n'hi ha
+def _csr_dijkstra(matrix, org, dest):
+
+    dist, pred = scipy.sparse.csgraph.dijkstra(matrix, indices=org, return_predecessors=True)
+
+    if dist[dest] == math.inf:
+        return None
+
+    return _predecessor_path(pred, org, dest)
+
+
+# Dijkstra depenent del temps: cada etiqueta porta el cost i el rellotge del trajecte (segons a la velocitat de cada via,
+# com Route.time). El cost d'un tram depen de quan s'hi entra (_forecast_weight): amb la congestio actual abans de
+# l'horitzo (per defecte FORECAST_HORIZON) i amb la prevista a partir d'ell. Cada node es tanca un sol cop, amb
+# l'etiqueta de menys cost, i el cami no repeteix mai cap node. Retorna les posicions dels nodes del cami, None si no n'hi ha
+def _csr_tdijkstra(igraph, org, dest, horizon=None):
+
+    horizon = FORECAST_HORIZON if horizon is None else horizon
+    offsets, targets, seconds, current, upcoming = _get_forecast(igraph.system, igraph.weights)['edges']
+
+    dist = {org: 0.0}
+    clock = {org: 0.0}
+    pred = {org: None}
+    heap = [(0.0, org)]
+    settled = set()
+
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if node in settled: continue
+        if node == dest: break
+        settled.add(node)
+
+        # Tots els trams que surten del node s'hi entren al mateix moment
+        itime = current if clock[node] < horizon else upcoming
+        for k in range(offsets[node], offsets[node + 1]):
+            next_cost = cost + itime[k]
+            next_node = targets[k]
+
+            # Les vies tallades tenen cost infinit i no milloren mai
+            if next_cost < dist.get(next_node, math.inf):
+                dist[next_node] = next_cost
+                clock[next_node] = clock[node] + seconds[k]
+                pred[next_node] = node
+                heapq.heappush(heap, (next_cost, next_node))
+
+    if dest not in pred:
+        return None
+
+    path = [dest]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+
+    path.reverse()
+    return path
+
+
+# Cost d'un tram on s'entra quan el rellotge del trajecte marca "clock" segons: "current" (congestio actual)
+# abans de l'horitzo i "upcoming" (congestio prevista) a partir d'ell
+def _forecast_weight(clock, current, upcoming, horizon=None):
+
+    horizon = FORECAST_HORIZON if horizon is None else horizon
+    return current if clock < horizon else upcoming
+
+
+# Cost (amb congestio) de fer un cami sortint ara, amb la congestio prevista pels trams on s'entra despres de l'horitzo
+def _forecast_cost(csr, weights, path, horizon=None):
+
+    clock = cost = 0.0
+    for node1, node2 in zip(path[:-1], path[1:]):
+        edge = _csr_edge(csr, node1, node2)
+        cost += _forecast_weight(clock, float(weights.itime[edge]), float(weights.next_itime[edge]), horizon)
+        clock += float(csr.time[edge]) * TIME_UNIT_SECONDS
+
+    return cost
+
+
+# Reconstrueix el cami fins a "dest" a partir dels predecessors d'un Dijkstra des de "org"
+def _predecessor_path(pred, org, dest):
+
+    path = [dest]
+    while path[-1] != org:
+        path.append(int(pred[path[-1]]))
+
+    path.reverse()
+    return path
+
+
+# Temps en segons, cost, distancia i nodes d'OSM d'un cami (posicions del CSR), None si no hi ha cami
+# Amb el mode 'tdijkstra' el cost te en compte la congestio prevista
+def _make_route(igraph, path, mode=None):
+
+    if path is None:
+        return None
+
+    csr = igraph.csr
+    edges = [_csr_edge(csr, node1, node2) for node1, node2 in zip(path[:-1], path[1:])]
+
+    if (mode or ROUTING_MODE) == 'tdijkstra':
+        cost = _forecast_cost(csr, igraph.weights, path)
+    else:
+        cost = float(igraph.weights.itime[edges].sum())
+
+    return Route(float(csr.time[edges].sum()) * TIME_UNIT_SECONDS, cost, float(csr.length[edges].sum()), csr.nodes[path].tolist())
+
+
+# Segons des de l'origen fins a cada node seguint l'arbre d'un Dijkstra ("dist" i "pred" d'un sol origen), inf on no s'hi arriba
+# "tails" es el node de sortida de cada aresta. Cada node suma el temps de l'aresta per on hi arriba i despres
+# es fan salts doblant la distancia: a cada pas cada node suma el que porta el seu avantpassat i salta al seu
+def _tree_seconds(csr, tails, dist, pred):
+
+    n = len(csr.nodes)
+    on_tree = pred[csr.targets] == tails
+
+    seconds = np.zeros(n)
+    seconds[csr.targets[on_tree]] = csr.time[on_tree] * TIME_UNIT_SECONDS
+
+    parent = np.where(pred >= 0, pred, np.arange(n))
+    while True:
+        seconds = seconds + np.where(parent != np.arange(n), seconds[parent], 0.0)
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    seconds[np.isinf(dist)] = math.inf
+    return seconds
+
+
+# A* sobre el CSR amb l'heuristica de la distancia en linia recta fins al desti
+# Retorna la llista de posicions dels nodes del cami, None si no n'hi ha
+# Si es passa "stats", s'hi guarda el nombre de nodes visitats
+def _csr_astar(csr, weights, min_cost, org, dest, stats=None):
+
+    offsets, targets, itime = csr.offsets, csr.targets, weights.itime
+
+    # Cota inferior del itime que falta des de cada node fins al desti
+    heuristic = min_cost * _haversine_to(csr, dest)
+
+    dist = {org: 0.0}
+    pred = {org: None}
+    settled = set()
+    heap = [(heuristic[org], 0.0, org)]
+
+    while heap:
+        _, cost, node = heapq.heappop(heap)
+
+        if node in settled: continue
+        settled.add(node)
+
+        if node == dest: break
+
+        for k in range(offsets[node], offsets[node + 1]):
+            next_cost = cost + itime[k]
+            next_node = int(targets[k])
+
+            # Les vies tallades tenen cost infinit i no milloren mai
+            if next_cost < dist.get(next_node, math.inf):
+                dist[next_node] = next_cost
+                pred[next_node] = node
+                heapq.heappush(heap, (next_cost + heuristic[next_node], next_cost, next_node))
+
+    if stats is not None:
+        stats['settled'] = len(settled)
+
+    if dest not in settled:
+        return None
+
+    path = [dest]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+
+    path.reverse()
+    return path
+
+
+# Dijkstra bidireccional sobre el CSR: una cerca des de l'origen i una altra cap enrere des del desti
+# Retorna la llista de posicions dels nodes del cami, None si no n'hi ha
+# Si es passa "stats", s'hi guarda el nombre de nodes visitats per les dues cerques
+def _csr_bidijkstra(igraph, org, dest, stats=None):
+
+    reverse = _get_reverse(igraph.system, igraph.weights)
+
+    # Arestes de sortida (cap endavant) i d'entrada (cap enrere): (offsets, veins, itime)
+    sides = [reverse['forward'], reverse['backward']]
+    dist = [{org: 0.0}, {dest: 0.0}]
+    pred = [{org: None}, {dest: None}]
+    settled = [set(), set()]
+    heaps = [[(0.0, org)], [(0.0, dest)]]
+
+    best, meeting = (0.0, org) if org == dest else (math.inf, None)
+
+    while heaps[0] and heaps[1]:
+
+        # Cap cami pot millorar el millor trobat si la suma dels dos fronts ja el supera
+        if heaps[0][0][0] + heaps[1][0][0] >= best: break
+
+        # S'avanca pel costat amb el front mes petit
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        offsets, neighbours, itime = sides[side]
+        own, other = dist[side], dist[1 - side]
+
+        cost, node = heapq.heappop(heaps[side])
+        if node in settled[side]: continue
+        settled[side].add(node)
+
+        for k in range(offsets[node], offsets[node + 1]):
+            next_cost = cost + itime[k]
+            next_node = neighbours[k]
+
+            # Les vies tallades tenen cost infinit i no milloren mai
+            if next_cost < own.get(next_node, math.inf):
+                own[next_node] = next_cost
+                pred[side][next_node] = node
+                heapq.heappush(heaps[side], (next_cost, next_node))
+
+                if next_node in other and next_cost + other[next_node] < best:
+                    best, meeting = next_cost + other[next_node], next_node
+
+    if stats is not None:
+        stats['settled'] = len(settled[0]) + len(settled[1])
+
+    if meeting is None:
+        return None
+
+    path = [meeting]
+    while pred[0][path[-1]] is not None:
+        path.append(pred[0][path[-1]])
+    path.reverse()
+
+    while pred[1][path[-1]] is not None:
+        path.append(pred[1][path[-1]])
+
+    return path
+
+
+# Retorna les adjacencies del Dijkstra bidireccional: les arestes de sortida i les d'entrada (el graf al reves)
+# de cada node, en llistes de Python (mes rapides d'indexar que els arrays en un bucle)
+# La forma del graf es construeix un sol cop per regio i els pesos un sol cop per versio publicada
+def _get_reverse(system, weights):
+
+    csr = system['csr']
+    reverse = system['reverse']
+    if reverse is None:
+        sources = np.repeat(np.arange(len(csr.nodes), dtype=np.int32), np.diff(csr.offsets))
+        edges = np.argsort(csr.targets, kind='stable')
+
+        offsets = np.zeros(len(csr.nodes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(csr.targets, minlength=len(csr.nodes)))
+
+        reverse = {'edges': edges, 'weights': None,
+                   'forward': (csr.offsets.tolist(), csr.targets.tolist(), None),
+                   'backward': (offsets.tolist(), sources[edges].tolist(), None)}
+
+    if reverse['weights'] is not weights:
+        reverse = dict(reverse, weights=weights,
+                       forward=reverse['forward'][:2] + (weights.itime.tolist(),),
+                       backward=reverse['backward'][:2] + (weights.itime[reverse['edges']].tolist(),))
+
+    system['reverse'] = reverse
+    return reverse
+
+
+# Retorna les adjacencies del Dijkstra depenent del temps: (offsets, veins, segons, itime actual, itime previst)
+# Les del graf es fan un sol cop per regio i els pesos un cop per versio publicada
+def _get_forecast(system, weights):
+
+    csr = system['csr']
+    forecast = system['forecast']
+    if forecast is None:
+        forecast = {'weights': None, 'graph': (csr.offsets.tolist(), csr.targets.tolist(), (csr.time * TIME_UNIT_SECONDS).tolist())}
+
+    if forecast['weights'] is not weights:
+        forecast = dict(forecast, weights=weights, edges=forecast['graph'] + (weights.itime.tolist(), weights.next_itime.tolist()))
+
+    system['forecast'] = forecast
+    return forecast
+
+
+# Distancia en metres (haversine) de tots els nodes del CSR fins al node "dest"
+def _haversine_to(csr, dest):
+
+    points = np.column_stack((csr.y, csr.x))
+    target = np.repeat(points[dest:dest + 1], len(points), axis=0)
+    return haversine.haversine_vector(points, target, haversine.Unit.METERS)
+
+
+# Cost minim (itime) per metre en linia recta: congestio minima dividida per la velocitat maxima
+# Multiplicat per la distancia haversine dona una heuristica admissible per l'A*
+def _min_cost(csr, weights):
+
+    moving = csr.time > 0
+    max_speed = np.max(csr.length[moving] / csr.time[moving])
+
+    # Factor de congestio minim de les vies obertes (itime = time * factor)
+    open_roads = moving & (weights.itime != math.inf)
+    factor = np.min(weights.itime[open_roads] / csr.time[open_roads]) if open_roads.any() else 1.0
+
+    return float(factor / max_speed) * ASTAR_MARGIN
+
+
+
+
+##################################################################
+##### Funcions Privades per la Jerarquia de Contraccio (CCH) #####
+##################################################################
+
+# Jerarquia de contraccio personalitzable (Customizable Contraction Hierarchy):
+#  - Preprocessat (un sol cop per graf): s'ordenen els nodes per disseccio niada
+#    (es parteix el mapa per la mediana de les coordenades i els nodes del separador
+#    van al final) i s'eliminen en aquest ordre sobre el graf no dirigit. Eliminar un
+#    node connecta entre si tots els seus veins, i cada node guarda els arcs cap als
+#    veins mes importants (rank mes alt). Cada arc te un pes de pujada (del node baix
+#    a l'alt) i un de baixada.
+#  - Personalitzacio (cada cop que canvien els pesos): es recorren els triangles
+#    inferiors {x, u, v} en ordre i es millora l'arc u-v passant per x.
+#  - Consulta: dues cerques cap amunt per l'arbre d'eliminacio, des de l'origen amb
+#    els pesos de pujada i des del desti amb els de baixada, que es troben als
+#    avantpassats comuns. Els nodes que ja no poden millorar el millor cami no es relaxen.
+
+
+# Retorna la jerarquia del graf d'una regio, la calcula o la llegeix de disc si no la tenim en memoria
+# Nomes un fil la calcula: la resta l'esperen (amb system['cch_lock']) en lloc de repetir el preprocessat
+def _get_cch(system):
+
+    cch = system['cch']
+    if cch is not None:
+        return cch
+
+    with system['cch_lock']:
+        if system['cch'] is not None:
+            return system['cch']
+
+        filename = _region_config(system['name']).cch_filename
+        key = system['graph_signature']
+        stored = None
+        if os.path.exists(filename):
+            with open(filename, 'rb') as file:
+                stored = pickle.load(file)
+
+        if stored is None or stored['key'] != key:
+            stored = {'key': key, 'cch': _build_cch(system['csr'])}
+            _save_pickle(stored, filename)
+
+        # Les consultes recorren els arcs un a un, en memoria es guarden com a llistes
+        # Els triangles nomes els fa servir la personalitzacio, que els recorre amb numpy per grups
+        cch = stored['cch']
+        cch = cch._replace(rank=cch.rank.tolist(), parent=cch.parent.tolist(), up_offsets=cch.up_offsets.tolist(), up_heads=cch.up_heads.tolist(), arc_tails=cch.arc_tails.tolist(),
+                           triangles=_triangle_levels(cch))
+
+        system['cch'] = cch
+        return cch
+
+
+# Retorna la jerarquia personalitzada amb uns pesos d'una regio. Es personalitza un sol cop per versio publicada
+def _get_cch_metric(system, weights):
+
+    metric = system['cch_metric']
+    if metric is not None and metric['weights'] is weights:
+        return metric['metric']
+
+    cch = _get_cch(system)
+
+    with system['cch_lock']:
+        metric = system['cch_metric']
+        if metric is None or metric['weights'] is not weights:
+            metric = {'weights': weights, 'metric': _customize_cch(cch, weights)}
+            system['cch_metric'] = metric
+
+        return metric['metric']
+
+
+# Agrupa els triangles inferiors (x->u, x->v, u->v) per l'altura de x a l'arbre d'eliminacio
+# u i v son avantpassats de x, i per tant els arcs u->v que es milloren en un grup son d'altures mes grans:
+# els arcs x->u i x->v que es llegeixen ja nomes els poden millorar grups anteriors
+# Retorna una llista de grups (x->u, x->v, u->v, x) d'arrays de numpy, de menys a mes altura
+def _triangle_levels(cch):
+
+    parent = cch.parent.tolist()
+    height = [0] * len(parent)
+    for node in np.argsort(cch.rank).tolist():
+        if parent[node] != -1:
+            height[parent[node]] = max(height[parent[node]], height[node] + 1)
+
+    triangles = cch.triangles
+    lower = cch.arc_tails[triangles[:, 0]]
+    level = np.array(height, dtype=np.int64)[lower]
+    order = np.argsort(level, kind='stable')
+    bounds = np.flatnonzero(np.diff(level[order])) + 1
+
+    levels = []
+    for indices in np.split(order, bounds):
+        group = triangles[indices]
+        levels.append((group[:, 0], group[:, 1], group[:, 2], lower[indices]))
+
+    return levels
+
+
+# Preprocessat de la jerarquia (independent dels pesos)
+def _build_cch(csr):
+
+    n = len(csr.nodes)
+    offsets, targets = csr.offsets.tolist(), csr.targets.tolist()
+
+    # Graf no dirigit sense bucles
+    adj = [set() for _ in range(n)]
+    for node1 in range(n):
+        for k in range(offsets[node1], offsets[node1 + 1]):
+            node2 = targets[k]
+            if node1 != node2:
+                adj[node1].add(node2)
+                adj[node2].add(node1)
+
+    # Eliminacio en l'ordre de la disseccio: els veins d'un node eliminat formen un clique
+    rank = [-1] * n
+    up = [None] * n
+
+    for order, node in enumerate(_nested_dissection(csr, adj)):
+        rank[node] = order
+        up[node] = adj[node]
+
+        for neighbour in up[node]:
+            adj[neighbour].discard(node)
+            adj[neighbour] |= up[node] - {neighbour}
+
+    # Arcs cap amunt de cada node, ordenats per node per poder-los buscar
+    up_offsets = np.zeros(n + 1, dtype=np.int64)
+    up_heads = []
+    for node in range(n):
+        up[node] = sorted(up[node])
+        up_heads.extend(up[node])
+        up_offsets[node + 1] = len(up_heads)
+
+    arc_tails = np.repeat(np.arange(n, dtype=np.int32), np.diff(up_offsets))
+    arc = {(int(arc_tails[a]), head): a for a, head in enumerate(up_heads)}
+
+    # El pare a l'arbre d'eliminacio es el vei amunt amb el rank mes baix
+    parent = np.array([min(up[node], key=rank.__getitem__) if up[node] else -1 for node in range(n)], dtype=np.int32)
+
+    # Triangles inferiors en ordre de rank del node de sota: (x->u, x->v, u->v) amb rank[u] < rank[v]
+    triangles = []
+    for x in sorted(range(n), key=rank.__getitem__):
+        heads = sorted(up[x], key=rank.__getitem__)
+        for i in range(len(heads)):
+            for j in range(i + 1, len(heads)):
+                triangles.append((arc[(x, heads[i])], arc[(x, heads[j])], arc[(heads[i], heads[j])]))
+
+    # Arc i sentit de cada aresta del CSR (-1 pels bucles)
+    edge_arcs = np.full(len(targets), -1, dtype=np.int64)
+    edge_up = np.zeros(len(targets), dtype=bool)
+    for node1 in range(n):
+        for k in range(offsets[node1], offsets[node1 + 1]):
+            node2 = targets[k]
+            if node1 == node2: continue
+            if rank[node1] < rank[node2]:
+                edge_arcs[k], edge_up[k] = arc[(node1, node2)], True
+            else:
+                edge_arcs[k] = arc[(node2, node1)]
+
+    return CCH(
+        rank=np.array(rank, dtype=np.int32),
+        parent=parent,
+        up_offsets=up_offsets,
+        up_heads=np.array(up_heads, dtype=np.int32),
+        arc_tails=arc_tails,
+        triangles=np.array(triangles, dtype=np.int64).reshape(-1, 3),
+        edge_arcs=edge_arcs,
+        edge_up=edge_up)
+
+
+# Ordre d'eliminacio dels nodes per disseccio niada geometrica
+# Es parteix cada regio per la mediana de la coordenada amb mes extensio; el separador son
+# els nodes d'una meitat amb algun vei a l'altra, i s'ordena despres de les dues meitats
+def _nested_dissection(csr, adj):
+
+    # Coordenades aproximadament en metres perque les dues direccions siguin comparables
+    x = (csr.x * math.cos(math.radians(float(np.mean(csr.y))))).tolist()
+    y = csr.y.tolist()
+
+    order = []
+    stack = [(list(range(len(x))), False)]
+
+    while stack:
+        nodes, done = stack.pop()
+
+        # Regio ja partida: nomes falta el separador
+        if done or len(nodes) <= CCH_LEAF_SIZE:
+            order.extend(nodes)
+            continue
+
+        spread_x = max(x[node] for node in nodes) - min(x[node] for node in nodes)
+        spread_y = max(y[node] for node in nodes) - min(y[node] for node in nodes)
+        coord = x if spread_x >= spread_y else y
+
+        nodes = sorted(nodes, key=coord.__getitem__)
+        half = len(nodes) // 2
+        left, right = set(nodes[:half]), set(nodes[half:])
+
+        # Separador: la frontera mes petita de les dues meitats
+        left_border = {node for node in left if not adj[node].isdisjoint(right)}
+        right_border = {node for node in right if not adj[node].isdisjoint(left)}
+        separator = left_border if len(left_border) <= len(right_border) else right_border
+
+        # Les meitats es processen abans que el separador (la pila es LIFO)
+        stack.append((sorted(separator), True))
+        stack.append(([node for node in nodes[half:] if node not in separator], False))
+        stack.append(([node for node in nodes[:half] if node not in separator], False))
+
+    return order
+
+
+# Personalitza la jerarquia amb uns pesos del CSR
+def _customize_cch(cch, weights):
+
+    n_arcs = len(cch.up_heads)
+    up = np.full(n_arcs, math.inf)
+    down = np.full(n_arcs, math.inf)
+
+    # Pesos de les arestes originals (les vies tallades queden a infinit)
+    valid = cch.edge_arcs >= 0
+    going_up = valid & cch.edge_up
+    going_down = valid & ~cch.edge_up
+    np.minimum.at(up, cch.edge_arcs[going_up], weights.itime[going_up])
+    np.minimum.at(down, cch.edge_arcs[going_down], weights.itime[going_down])
+
+    mid_up = np.full(n_arcs, -1, dtype=np.int64)
+    mid_down = np.full(n_arcs, -1, dtype=np.int64)
+
+    # Triangles inferiors: u -> x -> v i v -> x -> u. Cada grup (veure _triangle_levels) es fa d'un cop
+    for xu, xv, uv, x in cch.triangles:
+
+        through_up, through_down = down[xu] + up[xv], down[xv] + up[xu]
+
+        for cost, best, mid in ((through_up, up, mid_up), (through_down, down, mid_down)):
+            before = best[uv]
+            np.minimum.at(best, uv, cost)
+            improved = (cost < before) & (cost == best[uv])
+            mid[uv[improved]] = x[improved]
+
+    return CCHMetric(up.tolist(), down.tolist(), mid_up.tolist(), mid_down.tolist())
+
+
+# Cami mes curt amb la jerarquia. Retorna la llista de posicions dels nodes, None si no n'hi ha
+def _cch_query(cch, metric, org, dest):
+
+    rank, parent = cch.rank, cch.parent
+    forward = ({org: 0.0}, {org: None})
+    backward = ({dest: 0.0}, {dest: None})
+    best, meeting = math.inf, None
+
+    # Pugem per les dues branques de l'arbre, sempre pel node amb el rank mes baix.
+    # Quan les branques s'ajunten, els nodes son comuns i poden ser el punt de trobada
+    node1, node2 = org, dest
+    while node1 != -1 or node2 != -1:
+
+        if node2 == -1 or (node1 != -1 and rank[node1] < rank[node2]):
+            _cch_relax(cch, metric.up, forward, node1, best)
+            node1 = parent[node1]
+
+        elif node1 == -1 or rank[node2] < rank[node1]:
+            _cch_relax(cch, metric.down, backward, node2, best)
+            node2 = parent[node2]
+
+        else:
+            cost = forward[0].get(node1, math.inf) + backward[0].get(node1, math.inf)
+            if cost < best:
+                best, meeting = cost, node1
+
+            _cch_relax(cch, metric.up, forward, node1, best)
+            _cch_relax(cch, metric.down, backward, node1, best)
+            node1 = node2 = parent[node1]
+
+    if meeting is None:
+        return None
+
+    # Arcs de la jerarquia: de l'origen fins al node comu (pujant) i d'alla fins al desti (baixant)
+    arcs = []
+    node = meeting
+    while forward[1][node] is not None:
+        arcs.append((forward[1][node], True))
+        node = cch.arc_tails[forward[1][node]]
+    arcs.reverse()
+
+    node = meeting
+    while backward[1][node] is not None:
+        arcs.append((backward[1][node], False))
+        node = cch.arc_tails[backward[1][node]]
+
+    # Desempaquetem els arcs fins a arribar a arestes originals
+    path = [org]
+    stack = list(reversed(arcs))
+    while stack:
+        arc, going_up = stack.pop()
+        tail, head = cch.arc_tails[arc], cch.up_heads[arc]
+        mid = metric.mid_up[arc] if going_up else metric.mid_down[arc]
+
+        if mid == -1:
+            path.append(head if going_up else tail)
+
+        # tail -> mid -> head (o al reves si baixem)
+        elif going_up:
+            stack.append((_cch_arc(cch, mid, head), True))
+            stack.append((_cch_arc(cch, mid, tail), False))
+        else:
+            stack.append((_cch_arc(cch, mid, tail), True))
+            stack.append((_cch_arc(cch, mid, head), False))
+
+    return path
+
+
+# Relaxa els arcs cap amunt d'un node de la cerca. "labels" son els diccionaris node -> cost
+# i node -> arc pel que s'hi arriba. Si el cost del node ja no es menor que "bound" no pot
+# millorar el cami i no es relaxa
+def _cch_relax(cch, weight, labels, node, bound):
+
+    dist, via = labels
+    cost = dist.get(node, math.inf)
+    if cost >= bound:
+        return
+
+    up_heads = cch.up_heads
+    for arc in range(cch.up_offsets[node], cch.up_offsets[node + 1]):
+        next_cost = cost + weight[arc]
+        head = up_heads[arc]
+        if next_cost < dist.get(head, math.inf):
+            dist[head] = next_cost
+            via[head] = arc
+
+
+# Posicio de l'arc (tail, head) de la jerarquia, amb rank[tail] < rank[head]
+def _cch_arc(cch, tail, head):
+
+    return bisect.bisect_left(cch.up_heads, head, cch.up_offsets[tail], cch.up_offsets[tail + 1])
+
+
+
+
+###########################################################
+##### Funcions Privades per Calcular el cami mes Curt #####
+###########################################################
+
+
+# Retorna els pesos de la versió "inteligent" del graf de la ciutat.
+# "index" es l'index de trams (veure _get_tram_index)
+def _build_igraph(csr, index, congestions):
+
+    with span('build_igraph'):
+        weights = _base_weights(csr)
+        _update_igraph(csr, weights, index, {}, congestions)
+        return weights
+
+
+# Actualitza uns pesos que tenen aplicades les congestions "old" perque tinguin les congestions "new"
+# Nomes es toquen les arestes dels trams que han canviat d'estat. Retorna el nombre d'arestes tocades
+def _update_igraph(csr, weights, index, old, new):
+
+    # Trams amb un estat actual o previst diferent (o que han aparegut / desaparegut del fitxer)
+    changed = [key for key in index['eids'] if old.get(key) != new.get(key)]
+
+    # Arestes afectades
+    edges = set()
+    for key in changed:
+        edges.update(index['eids'][key])
+
+    for edge in edges:
+
+        # Tornem l'aresta al seu estat base
+        weights.congestion[edge] = csr.congestion[edge]
+        weights.itime[edge] = csr.itime[edge]
+        weights.next_itime[edge] = csr.itime[edge]
+
+        # Apliquem tots els trams que la cobreixen, preval el darrer
+        for key in index['trams'][edge]:
+            if key in new:
+                _congestion_propagation(csr, weights, [edge], new[key].state, new[key].next_state)
+
+    return len(edges)
+
+
+# Retorna el cami "inteligent" entre dues posicions del CSR
+def _get_shortest_ipath(igraph, org, dest, mode=None):
+
+    mode = mode or ROUTING_MODE
+
+    if mode == 'astar':
+        return _csr_astar(igraph.csr, igraph.weights, igraph.min_cost, org, dest)
+
+    if mode == 'dijkstra':
+        return _csr_dijkstra(igraph.matrix, org, dest)
+
+    if mode == 'bidijkstra':
+        return _csr_bidijkstra(igraph, org, dest)
+
+    if mode == 'tdijkstra':
+        return _csr_tdijkstra(igraph, org, dest)
+
+    if mode == 'cch':
+        # Si els pesos no s'han personalitzat en publicar-los, es fa la primera vegada que es demanen
+        metric = igraph.cch or _get_cch_metric(igraph.system, igraph.weights)
+        return _cch_query(_get_cch(igraph.system), metric, org, dest)
+
+    raise ValueError('Mode de cerca desconegut: %s' % mode)
+
+
+# Propaga la congestio actual i la prevista d'un tram a les seves arestes (posicions del CSR)
+# Si no hi ha previsio (0) es mante l'actual. El graf no es modifica, la congestio es guarda als pesos
+def _congestion_propagation(csr, weights, edges, congestion, next_congestion):
+
+    for edge in edges:
+
+        weights.congestion[edge] = congestion
+        weights.itime[edge] = _calculate_itime(csr.time[edge], congestion)
+        weights.next_itime[edge] = _calculate_itime(csr.time[edge], next_congestion or congestion)
+
+
+# Com _calculate_itime, per arrays de temps i congestions
+def _calculate_itimes(time, congestion):
+
+    congestion = np.where(congestion == 0, GENERIC_CONGESTION, congestion)
+    return np.where(congestion == 6, math.inf, time * np.sqrt(congestion))
+
+
+# Calcula el itime a partir de un temps i una congestio
+def _calculate_itime(time, congestion):
+
+    # Via tallada: no es pot passar
+    if congestion == 6:
+        return math.inf
+
+    # Via sense informacio
+    if congestion == 0:
+        congestion = GENERIC_CONGESTION
+
+    return time * math.sqrt(congestion)
+
+
+
+
+##########################################
+##### Funcions Privades de Metriques #####
+##########################################
+
+
+# Afegeix una durada (segons) a l'histograma d'una etapa
+def _observe(stage, seconds, labels):
+
+    key = tuple(sorted(dict(labels, stage=stage).items()))
+
+    with _metrics_lock:
+        histogram = _metrics['histograms'].get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0}
+            _metrics['histograms'][key] = histogram
+
+        # Es guarda el nombre de valors de cada interval, a l'exportar s'acumulen
+        i = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        if i < len(METRICS_BUCKETS):
+            histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+# Dona el valor actual d'una metrica igo_<name>
+def _set_gauge(name, value, **labels):
+
+    with _metrics_lock:
+        _metrics['gauges'][(name, tuple(sorted(labels.items())))] = value
+
+
+# Etiquetes en format Prometheus: {nom="valor",...}
+def _format_labels(labels):
+
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+
+
+#########################################
+##### Funcions Auxiliars de Testeig #####
+#########################################
+
+
+# Serveix els fitxers d'un directori per HTTP (amb ETag i Last-Modified) en un fil en segon pla
+# Permet provar el refresc sense l'Ajuntament: les URL son 'http://127.0.0.1:<server.server_port>/<fitxer>'
+def _serve_feeds(dirname, port=0):
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=dirname, **kwargs)
+
+        def send_head(self):
+            try:
+                stat = os.stat(self.translate_path(self.path))
+            except OSError:
+                return super().send_head()
+
+            etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return None
+
+            self._etag = etag
+            return super().send_head()
+
+        def end_headers(self):
+            if getattr(self, '_etag', None):
+                self.send_header('ETag', self._etag)
+                self._etag = None
+            super().end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, name='igo-feeds', daemon=True).start()
+    return server
+
+
+# Compara el cost dels camins del CSR amb els de networkx sobre els mateixos pesos
+# Retorna el nombre de parelles origen-desti amb un cost diferent
+def _check_csr(igraph, n, seed=0):
+
+    csr, weights = igraph.csr, igraph.weights
+    graph = _load_graph(_region_config(igraph.system['name']).graph_filename)
+    rnd = random.Random(seed)
+    errors = 0
+
+    # Funcio de pes de networkx amb els pesos del CSR (les vies tallades s'ignoren)
+    def weight(node1, node2, data):
+        itime = weights.itime[_csr_edge(csr, csr.index[node1], csr.index[node2])]
+        return None if itime == math.inf else itime
+
+    for _ in range(n):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+
+        try:
+            expected = nx.shortest_path_length(graph, int(csr.nodes[org]), int(csr.nodes[dest]), weight=weight)
+        except nx.NetworkXNoPath:
+            expected = None
+
+        path = _get_shortest_ipath(igraph, org, dest)
+        cost = None if path is None else sum(weights.itime[_csr_edge(csr, i, j)] for i, j in zip(path[:-1], path[1:]))
+
+        if (expected is None) != (cost is None) or (cost is not None and abs(expected - cost) > 1e-9 * max(1, cost)):
+            errors += 1
+
+    return errors
+
+
+# Compara el cost dels camins de l'A* amb els del Dijkstra
+# Retorna el nombre de parelles amb un cost diferent i la mitjana de nodes visitats per l'A*
+def _check_astar(igraph, n, seed=0):
+
+    csr, weights = igraph.csr, igraph.weights
+    rnd = random.Random(seed)
+    errors = 0
+    settled = 0
+
+    for _ in range(n):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+        stats = {}
+
+        costs = []
+        for path in (_get_shortest_ipath(igraph, org, dest, 'dijkstra'), _csr_astar(csr, weights, igraph.min_cost, org, dest, stats)):
+            costs.append(None if path is None else sum(weights.itime[_csr_edge(csr, i, j)] for i, j in zip(path[:-1], path[1:])))
+
+        expected, cost = costs
+        if (expected is None) != (cost is None) or (cost is not None and abs(expected - cost) > 1e-9 * max(1, cost)):
+            errors += 1
+
+        settled += stats['settled']
+
+    return errors, settled / n
+
+
+# Compara el cost dels camins del Dijkstra bidireccional amb els del Dijkstra
+# Retorna el nombre de parelles amb un cost diferent i la mitjana de nodes visitats per les dues cerques
+def _check_bidijkstra(igraph, n, seed=0):
+
+    csr, weights = igraph.csr, igraph.weights
+    rnd = random.Random(seed)
+    errors = 0
+    settled = 0
+
+    for _ in range(n):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+        stats = {}
+
+        expected = _path_cost(csr, weights, _get_shortest_ipath(igraph, org, dest, 'dijkstra'))
+        path = _csr_bidijkstra(igraph, org, dest, stats)
+        cost = _path_cost(csr, weights, path)
+
+        if (expected is None) != (cost is None) or (cost is not None and (abs(expected - cost) > 1e-9 * max(1, cost) or path[0] != org or path[-1] != dest)):
+            errors += 1
+
+        settled += stats['settled']
+
+    return errors, settled / n
+
+
+# Compara el cost dels camins del Dijkstra depenent del temps amb una versio senzilla en Python que pesa cada tram
+# amb _forecast_weight segons el rellotge del node d'on surt. Tambe comprova que els camins no repeteixin nodes
+# Retorna el nombre de parelles amb un cost diferent
+def _check_tdijkstra(igraph, n, seed=0, horizon=None):
+
+    csr, weights = igraph.csr, igraph.weights
+    rnd = random.Random(seed)
+    errors = 0
+
+    for _ in range(n):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+
+        dist, clock = {org: 0.0}, {org: 0.0}
+        heap = [(0.0, org)]
+        settled = set()
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node in settled: continue
+            settled.add(node)
+            for edge in range(csr.offsets[node], csr.offsets[node + 1]):
+                target = int(csr.targets[edge])
+                next_cost = cost + _forecast_weight(clock[node], float(weights.itime[edge]), float(weights.next_itime[edge]), horizon)
+                if next_cost < dist.get(target, math.inf):
+                    dist[target] = next_cost
+                    clock[target] = clock[node] + float(csr.time[edge]) * TIME_UNIT_SECONDS
+                    heapq.heappush(heap, (next_cost, target))
+
+        expected = dist.get(dest, math.inf)
+        path = _csr_tdijkstra(igraph, org, dest, horizon)
+        cost = math.inf if path is None else _forecast_cost(csr, weights, path, horizon)
+
+        if (expected == math.inf) != (cost == math.inf) or (cost != math.inf and (abs(expected - cost) > 1e-9 * max(1, cost) or path[0] != org or path[-1] != dest or len(set(path)) != len(path))):
+            errors += 1
+
+    return errors
+
+
+# Compara el cost dels camins de la jerarquia de contraccio amb els del Dijkstra
+# Retorna el nombre de parelles amb un cost diferent
+def _check_cch(igraph, n, seed=0):
+
+    csr, weights = igraph.csr, igraph.weights
+    cch = _get_cch(igraph.system)
+    metric = _customize_cch(cch, weights)
+    rnd = random.Random(seed)
+    errors = 0
+
+    for _ in range(n):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+
+        expected = _path_cost(csr, weights, _get_shortest_ipath(igraph, org, dest, 'dijkstra'))
+        path = _cch_query(cch, metric, org, dest)
+        cost = _path_cost(csr, weights, path)
+
+        if (expected is None) != (cost is None) or (cost is not None and (abs(expected - cost) > 1e-9 * max(1, cost) or path[0] != org or path[-1] != dest)):
+            errors += 1
+
+    return errors
+
+
+# Cost (itime) d'un cami de posicions del CSR, None si no hi ha cami
+def _path_cost(csr, weights, path):
+
+    if path is None:
+        return None
+
+    return sum(weights.itime[_csr_edge(csr, i, j)] for i, j in zip(path[:-1], path[1:]))
 
 
 # Mostra el graf per pantalla
@@ -400,7 +2790,7 @@ def _plot_graph(graph, image_name):
 def _plot_highways(highways, image_name, size):
 
     # Creem el mapa
-    m_bcn = sm.StaticMap(2000, 2000)
+    m_bcn = _new_map(2000, 2000)
 
     #Per cada segment
     for key in highways:
@@ -422,7 +2812,7 @@ def _plot_highways(highways, image_name, size):
 def _plot_congestions(highways, congestions, image_name, size):
 
     # Creem el mapa
-    m_bcn = sm.StaticMap(size, size)
+    m_bcn = _new_map(size, size)
 
     #Per cada segment
     for key in highways:
@@ -462,7 +2852,7 @@ def _plot_congestions(highways, congestions, image_name, size):
 # No te control d'errors
 def _plot_one_highway(highways, tram, size):
 
-    m_bcn = sm.StaticMap(size, size)
+    m_bcn = _new_map(size, size)
 
     # Canviem el nom per escriure-ho mes facil
     coords = highways[tram].coordinates
@@ -480,7 +2870,7 @@ def _plot_one_highway(highways, tram, size):
 # No te control d'errors
 def _plot_first_segment(highways, tram, size):
 
-    m_bcn = sm.StaticMap(size, size)
+    m_bcn = _new_map(size, size)
     m_bcn.add_line(sm.Line(((float(highways[tram].coordinates[0]), float(highways[tram].coordinates[1])), (float(highways[tram].coordinates[2]), float(highways[tram].coordinates[3]))), 'red', 3))
 
     image = m_bcn.render()
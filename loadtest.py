@@ -0,0 +1,218 @@
+import bot
+import igo
+import asyncio
+import email
+import http.server
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+
+
+
+# Constants
+TOKEN = '123:loadtest'
+N_CHATS = 50 # Usuaris simultanis
+N_REQUESTS = 4 # Peticions /go de cada usuari
+SEND_LATENCY = 0.05 # Segons que tarda el servidor fals en respondre cada missatge (com la xarxa fins a Telegram)
+POLL_TIMEOUT = 1 # Segons que el servidor fals espera noves actualitzacions a cada getUpdates
+SEED = 2021
+
+
+
+# Servidor fals de l'API de Telegram: lliura les actualitzacions encuades i apunta quan arriba cada resposta
+class _FakeTelegram(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _FakeTelegramHandler)
+        self.url = 'http://127.0.0.1:%d/bot' % self.server_port
+        self.condition = threading.Condition()
+        self.updates = []
+        self.sent = {} # Actualitzacio -> moment de la resposta
+        self.next_id = 1
+        self.next_message_id = 1
+
+    # Encua un missatge de text d'un xat i retorna el seu update_id
+    def push(self, chat_id, text):
+
+        with self.condition:
+            update_id = self.next_id
+            self.next_id += 1
+
+            message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+                       'chat': {'id': chat_id, 'type': 'private'},
+                       'from': {'id': chat_id, 'is_bot': False, 'first_name': 'usuari%d' % chat_id}}
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+
+            self.updates.append({'update_id': update_id, 'message': message, 'pushed': time.perf_counter(), 'chat_id': chat_id})
+            self.condition.notify_all()
+            return update_id
+
+    # Espera fins que s'hagin respost "n" missatges en total
+    def wait_sent(self, n, timeout=600):
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: sum(len(times) for times in self.sent.values()) >= n, timeout):
+                raise TimeoutError('Nomes s\'han rebut %d respostes de %d' % (sum(len(times) for times in self.sent.values()), n))
+
+
+class _FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = _parse_params(self.headers.get('Content-Type', ''), body)
+
+        result = getattr(self, '_' + method, self._default)(params)
+
+        content = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        # El bot talla el getUpdates pendent quan s'atura
+        try:
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _getMe(self, params):
+        return {'id': 1, 'is_bot': True, 'first_name': 'iGo', 'username': 'igo_loadtest_bot'}
+
+    def _getUpdates(self, params):
+
+        server = self.server
+        offset = int(params.get('offset') or 0)
+
+        with server.condition:
+            server.condition.wait_for(lambda: any(update['update_id'] >= offset for update in server.updates), POLL_TIMEOUT)
+            server.updates = [update for update in server.updates if update['update_id'] >= offset]
+            return [{'update_id': update['update_id'], 'message': update['message']} for update in server.updates]
+
+    def _sendMessage(self, params):
+        return self._sent(params, {'text': params.get('text', '')})
+
+    def _sendPhoto(self, params):
+        return self._sent(params, {'photo': [{'file_id': 'photo', 'file_unique_id': 'photo', 'width': igo.SIZE, 'height': igo.SIZE}]})
+
+    def _default(self, params):
+        return True
+
+    # Apunta la resposta (despres de la latencia simulada) i retorna el missatge enviat
+    def _sent(self, params, content):
+
+        time.sleep(SEND_LATENCY)
+
+        server = self.server
+        chat_id = int(params['chat_id'])
+
+        with server.condition:
+            server.sent.setdefault(chat_id, []).append(time.perf_counter())
+            message_id = server.next_message_id
+            server.next_message_id += 1
+            server.condition.notify_all()
+
+        return dict(content, message_id=message_id, date=int(time.time()), chat={'id': chat_id, 'type': 'private'})
+
+    def log_message(self, *args):
+        pass
+
+
+# Parametres d'una peticio a l'API: formulari, JSON o multipart (quan s'envia una imatge)
+def _parse_params(content_type, body):
+
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+
+    if content_type.startswith('multipart/form-data'):
+        message = email.message_from_bytes(b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n' + body)
+        return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True).decode('utf-8')
+                for part in message.get_payload() if part.get_filename() is None}
+
+    return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+
+# Envia "n_requests" /go de cada xat i mesura quant es tarda a respondre-les totes
+async def _drive(application, server, pairs, n_requests):
+
+    chats = list(pairs)
+
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=POLL_TIMEOUT)
+
+        # Cada usuari comenca i falseja la posicio d'origen (aquestes respostes no es mesuren)
+        for chat_id in chats:
+            server.push(chat_id, '/start')
+            server.push(chat_id, '/pos %f %f' % pairs[chat_id][0])
+        await asyncio.to_thread(server.wait_sent, len(chats))
+        server.sent.clear()
+
+        t0 = time.perf_counter()
+        pushed = []
+        for _ in range(n_requests):
+            for chat_id in chats:
+                server.push(chat_id, '/go %f %f' % pairs[chat_id][1])
+                pushed.append((chat_id, time.perf_counter()))
+        await asyncio.to_thread(server.wait_sent, len(pushed))
+        elapsed = time.perf_counter() - t0
+
+        await application.updater.stop()
+        await application.stop()
+
+    # Latencia de cada peticio: les respostes d'un xat arriben en ordre
+    replies = {chat_id: iter(times) for chat_id, times in server.sent.items()}
+    latencies = sorted((next(replies[chat_id]) - pushed_at) * 1000 for chat_id, pushed_at in pushed)
+
+    return elapsed, latencies
+
+
+# Mostra el resum d'una prova
+def _report(name, n, elapsed, latencies):
+
+    print('%-12s %6.1f peticions/s   mitjana %8.1f ms   p50 %8.1f ms   p95 %8.1f ms' % (
+        name, n / elapsed, statistics.mean(latencies), latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]))
+
+
+# Compara atendre les actualitzacions una darrere l'altra (com l'antic Updater) i concurrentment
+def load_test(n_chats=N_CHATS, n_requests=N_REQUESTS):
+
+    igo.start_system()
+    bot._start_workers()
+
+    # Origen i desti fixos de cada usuari, a partir dels nodes del graf
+    csr = igo._get_igraph().csr
+    rnd = random.Random(SEED)
+    pairs = {}
+    for chat_id in range(1, n_chats + 1):
+        org, dest = rnd.sample(range(len(csr.nodes)), 2)
+        pairs[chat_id] = ((float(csr.y[org]), float(csr.x[org])), (float(csr.y[dest]), float(csr.x[dest])))
+
+    for name, concurrent in (('sequencial', False), ('concurrent', True)):
+        server = _FakeTelegram()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        application = bot.build_application(TOKEN, base_url=server.url, concurrent=concurrent)
+        elapsed, latencies = asyncio.run(_drive(application, server, pairs, n_requests))
+        _report(name, n_chats * n_requests, elapsed, latencies)
+
+        server.shutdown()
+        server.server_close()
+
+    bot._stop_workers()
+
+
+
+if __name__ == '__main__':
+
+    n_chats = int(sys.argv[1]) if len(sys.argv) > 1 else N_CHATS
+    n_requests = int(sys.argv[2]) if len(sys.argv) > 2 else N_REQUESTS
+    load_test(n_chats, n_requests)
@@ -0,0 +1,126 @@
+import os
+import shutil
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+import benchmark
+import igo
+
+
+REGION = 'refresc' # Regio del graf sintetic de les proves
+SIDE = 10 # Nodes de cada costat de la quadricula
+FEEDS_REGION = 'remot' # Regio amb el mateix graf i les dades servides per HTTP
+SEED = 7
+
+
+# Graf sintetic del benchmark amb els seus trams i congestions, registrat com una regio amb les dades en fitxers locals
+# Els fitxers de la regio es creen al directori temporal, que es el directori actual durant les proves
+@pytest.fixture(scope='module')
+def system(tmp_path_factory):
+
+    dirname = tmp_path_factory.mktemp('refresh')
+    cwd = os.getcwd()
+    os.chdir(dirname)
+
+    try:
+        graph = benchmark._synthetic_city(SIDE, SEED)
+        igo._save_graph(graph, REGION + '.graph')
+        ways = benchmark._write_city_highways('highways.csv', graph, SIDE)
+        benchmark._write_city_congestions(['congestions.csv', 'congestions_next.csv'], ways, SEED, benchmark.SUITE_CHANGED)
+
+        igo.register_region(REGION, None, os.path.abspath('highways.csv'), os.path.abspath('congestions.csv'))
+        igo.refresh_igraph(REGION)
+        yield igo._load_system(REGION)
+    finally:
+        os.chdir(cwd)
+
+
+# Estat de la mateixa regio en un altre proces, que encara no ha llegit cap pes publicat
+def _other_process(system):
+
+    other = igo._new_system(system['name'])
+    other.update(csr=system['csr'], graph_signature=system['graph_signature'], version=1)
+    return other
+
+
+# Descarregues de fonts fetes des de "before" (un recompte anterior), per estat
+def _feed_fetches(before=None):
+
+    before = before or {}
+    counters = {labels[0][1]: value for (name, labels), value in igo._metrics['counters'].items() if name == 'feed_fetches'}
+    return {status: value - before.get(status, 0) for status, value in counters.items() if value != before.get(status, 0)}
+
+
+# Un proces que segueix el refresc mapeja els pesos que publica el que refresca, i nomes quan n'hi ha una versio nova
+def test_follower_maps_the_published_weights(system):
+
+    published = system['igraph']
+    igo._save_shared_weights(system, published)
+
+    follower = _other_process(system)
+    assert igo._follow_system(follower)
+
+    weights = follower['igraph'].weights
+    for field in igo.Weights._fields:
+        assert np.array_equal(getattr(weights, field), getattr(published.weights, field))
+    assert not weights.itime.flags.writeable
+
+    assert not igo._follow_system(follower)
+    assert os.path.exists(os.path.join(REGION + '_weights', 'wanted'))
+
+
+# Es conserven la darrera versio publicada i l'anterior, les mes velles s'esborren
+def test_only_the_last_two_versions_are_kept(system):
+
+    published = system['igraph']
+    for version in range(10, 13):
+        igo._save_shared_weights(system, published._replace(version=version))
+
+    versions = sorted(entry for entry in os.listdir(REGION + '_weights') if entry not in ('current.json', 'wanted'))
+    assert versions == ['%d.%d' % (os.getpid(), version) for version in (11, 12)]
+
+
+# Els pesos d'un altre graf (per exemple d'abans de tornar a descarregar-lo) no es fan servir
+def test_follower_ignores_weights_of_another_graph(system):
+
+    igo._save_shared_weights(system, system['igraph'])
+
+    follower = _other_process(system)
+    follower['graph_signature'] = 'un altre graf'
+    assert not igo._follow_system(follower)
+    assert follower['igraph'] is None
+
+
+# Les fonts que no han canviat no es tornen a descarregar (304) i, amb les mateixes dades, el refresc no toca cap aresta
+# Si el servidor falla (5xx) es fa servir la copia guardada
+def test_unchanged_feeds_are_not_downloaded_again(system, monkeypatch):
+
+    shutil.copy(REGION + '.graph', FEEDS_REGION + '.graph')
+    server = igo._serve_feeds(os.getcwd())
+
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_port
+        igo.register_region(FEEDS_REGION, None, url + 'highways.csv', url + 'congestions.csv')
+
+        before = _feed_fetches()
+        assert igo.refresh_igraph(FEEDS_REGION) > 0
+        assert _feed_fetches(before) == {'downloaded': 2}
+
+        version = igo._get_igraph(FEEDS_REGION).version
+        assert igo.refresh_igraph(FEEDS_REGION) == 0
+        assert _feed_fetches(before) == {'downloaded': 2, 'not_modified': 2}
+
+        def unavailable(request, timeout=None):
+            raise urllib.error.HTTPError(request.full_url, 503, 'Service Unavailable', {}, None)
+
+        monkeypatch.setattr(urllib.request, 'urlopen', unavailable)
+        assert igo.refresh_igraph(FEEDS_REGION) == 0
+        assert _feed_fetches(before) == {'downloaded': 2, 'not_modified': 2, 'failed': 2}
+        assert igo._get_igraph(FEEDS_REGION).version == version
+
+    finally:
+        server.shutdown()
+        server.server_close()
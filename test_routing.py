@@ -0,0 +1,142 @@
+import concurrent.futures
+import math
+import os
+
+import networkx as nx
+import numpy as np
+import pytest
+import scipy.sparse.csgraph
+
+import benchmark
+import igo
+
+
+REGION = 'proves' # Regio del graf sintetic de les proves
+SIDE = 30 # Nodes de cada costat de la quadricula
+QUERIES = 100 # Parelles origen-desti de cada comprovacio
+SEED = 7
+
+
+# Graf sintetic del benchmark amb els seus trams i congestions (hi ha vies tallades ara i obertes a la previsio)
+# Els fitxers de la regio es creen al directori temporal, que es el directori actual durant les proves
+@pytest.fixture(scope='module')
+def igraph(tmp_path_factory):
+
+    dirname = tmp_path_factory.mktemp('routing')
+    cwd = os.getcwd()
+    os.chdir(dirname)
+
+    try:
+        graph = benchmark._synthetic_city(SIDE, SEED)
+        igo._save_graph(graph, REGION + '.graph')
+        ways = benchmark._write_city_highways('highways.csv', graph, SIDE)
+        benchmark._write_city_congestions(['congestions.csv', 'congestions_next.csv'], ways, SEED, benchmark.SUITE_CHANGED)
+
+        igo.register_region(REGION, None, os.path.abspath('highways.csv'), os.path.abspath('congestions.csv'))
+        igo.refresh_igraph(REGION)
+        yield igo._get_igraph(REGION)
+    finally:
+        os.chdir(cwd)
+
+
+def test_fixture_has_roads_closed_now_and_open_later(igraph):
+
+    weights = igraph.weights
+    assert np.any(np.isinf(weights.itime) & np.isfinite(weights.next_itime))
+
+
+def test_csr(igraph):
+
+    assert igo._check_csr(igraph, QUERIES, SEED) == 0
+
+
+def test_astar(igraph):
+
+    assert igo._check_astar(igraph, QUERIES, SEED)[0] == 0
+
+
+def test_bidijkstra(igraph):
+
+    assert igo._check_bidijkstra(igraph, QUERIES, SEED)[0] == 0
+
+
+def test_cch(igraph):
+
+    assert igo._check_cch(igraph, QUERIES, SEED) == 0
+
+
+# Les primeres consultes 'cch' concurrents esperen la mateixa personalitzacio en lloc de fer-ne cada una la seva
+def test_cch_metric_is_customized_once(igraph):
+
+    igraph.system['cch_metric'] = None
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        metrics = list(pool.map(lambda _: igo._get_cch_metric(igraph.system, igraph.weights), range(8)))
+
+    assert all(metric is metrics[0] for metric in metrics)
+
+
+@pytest.mark.parametrize('horizon', [0, 60, 300, None, float('inf')])
+def test_tdijkstra(igraph, horizon):
+
+    assert igo._check_tdijkstra(igraph, QUERIES, SEED, horizon) == 0
+
+
+# Amb l'horitzo a 0 (o a l'infinit) tots els trams es pesen amb la congestio prevista (o l'actual): es un Dijkstra normal
+@pytest.mark.parametrize('horizon', [0, float('inf')])
+def test_tdijkstra_matches_dijkstra_at_the_extremes(igraph, horizon):
+
+    csr, weights = igraph.csr, igraph.weights
+    matrix = igo._build_matrix(csr, weights.next_itime if horizon == 0 else weights.itime)
+
+    for org in range(0, len(csr.nodes), 7):
+        dest = len(csr.nodes) - 1 - org
+        path = igo._csr_tdijkstra(igraph, org, dest, horizon)
+        cost = math.inf if path is None else igo._forecast_cost(csr, weights, path, horizon)
+        assert cost == pytest.approx(scipy.sparse.csgraph.dijkstra(matrix, indices=org)[dest])
+
+
+# Un tram car ara i barat a la previsio surt a compte si s'hi arriba despres de l'horitzo, encara que sigui per un cami mes llarg
+# O -> B -> D fa els dos trams amb la congestio actual (2000); O -> C -> B -> D arriba a C despres de l'horitzo (70)
+def test_tdijkstra_reaches_the_forecast_by_a_longer_road():
+
+    O, B, C, D = 0, 1, 2, 3
+    edges = {(O, B): (10, 1000, 10), (O, C): (150, 50, 50), (C, B): (10, 1000, 10), (B, D): (10, 1000, 10)} # segons, itime actual i previst
+
+    graph = nx.DiGraph()
+    for node in (O, B, C, D):
+        graph.add_node(node, x=2.15 + node * 0.001, y=41.4)
+    for (node1, node2), (seconds, current, _) in edges.items():
+        graph.add_edge(node1, node2, length=100.0, time=seconds / igo.TIME_UNIT_SECONDS, itime=float(current), congestion=0)
+
+    csr = igo._build_csr(graph)
+    upcoming = np.zeros(len(csr.targets))
+    for (node1, node2), (_, _, next_itime) in edges.items():
+        upcoming[igo._csr_edge(csr, node1, node2)] = next_itime
+
+    system = igo._new_system(REGION + '_quatre')
+    system['csr'] = csr
+    igraph = igo._make_igraph(system, igo.Weights(csr.congestion.copy(), csr.itime.copy(), upcoming), 1)
+
+    path = igo._csr_tdijkstra(igraph, O, D, 120)
+    assert path == [O, C, B, D]
+    assert igo._forecast_cost(csr, igraph.weights, path, 120) == 70
+    assert igo._check_tdijkstra(igraph, 10, SEED, 120) == 0
+
+
+# Amb un horitzo curt hi ha camins que fan vies tallades ara, i cap no repeteix nodes
+def test_tdijkstra_uses_roads_open_in_the_forecast(igraph):
+
+    csr, weights = igraph.csr, igraph.weights
+    closed = 0
+
+    for org in range(0, len(csr.nodes), 7):
+        path = igo._csr_tdijkstra(igraph, org, len(csr.nodes) - 1 - org, 60)
+        if path is None:
+            continue
+
+        assert len(set(path)) == len(path)
+        edges = [igo._csr_edge(csr, node1, node2) for node1, node2 in zip(path[:-1], path[1:])]
+        closed += bool(np.isinf(weights.itime[edges]).any())
+        assert igo._forecast_cost(csr, weights, path, 60) < float('inf')
+
+    assert closed > 0